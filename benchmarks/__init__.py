@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the FullBlog plugin.
+
+ * generator.py - creates a Trac environment filled with synthetic blog data
+ * suite.py - runs the benchmarks and stores/compares JSON baselines
+
+Run from the top of the source tree with Trac and the plugin installed:
+    python -m benchmarks.suite --sizes 1000,10000 --baseline bench.json
+
+License: BSD
+"""
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic blog generator.
+
+Creates a new SQLite Trac environment with the plugin enabled, and fills it
+with posts (with versions), comments, categories and attachment records.
+The content is generated from a fixed random seed, so the same arguments
+always give the same environment.
+
+    python -m benchmarks.generator /tmp/blogenv --posts 10000
+
+License: BSD
+"""
+
+import datetime
+import random
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    # Python 2.5 compat
+    import simplejson as json
+
+from trac.env import Environment
+from trac.perm import PermissionSystem
+from trac.util.datefmt import to_timestamp, utc
+
+from tracfullblog.bulk import import_blog
+from tracfullblog.db import FullBlogSetup
+
+__all__ = ['create_blog_env', 'generate_lines']
+
+words = ("trac blog plugin python wiki ticket milestone release build "
+         "cache index query template render feed comment author version "
+         "database server client request response process thread memory "
+         "network storage search timeline report").split()
+
+num_authors = 50
+num_categories = 200
+
+
+def generate_lines(posts=1000, versions=3, comments=5, seed=42):
+    """ Yields JSON lines in the 'fullblog import' format for the given
+    number of posts, versions per post and comments per post. """
+    rnd = random.Random(seed)
+    start = to_timestamp(datetime.datetime(2005, 1, 1, tzinfo=utc))
+    span = to_timestamp(datetime.datetime.now(utc)) - start
+    step = span // max(posts, 1)
+    for i in xrange(posts):
+        name = 'post-%07d' % i
+        author = 'user%02d' % rnd.randrange(num_authors)
+        categories = ' '.join(['cat%03d' % rnd.randrange(num_categories)
+                               for j in range(rnd.randrange(1, 5))])
+        published = start + i * step
+        title = ' '.join(rnd.sample(words, 5)).capitalize()
+        body = _paragraphs(rnd, 4)
+        post_versions = []
+        for version in range(1, versions + 1):
+            if version > 1:
+                # Edits change a few words of the body
+                body = body.replace(rnd.choice(words), rnd.choice(words), 1)
+            post_versions.append({'version': version, 'title': title,
+                'body': body, 'publish_time': published,
+                'version_time': published + (version - 1) * 3600,
+                'version_comment': version > 1 and 'Edit %d' % version or '',
+                'version_author': author, 'author': author,
+                'categories': categories})
+        yield json.dumps({'type': 'post', 'name': name,
+                          'versions': post_versions})
+        for number in range(1, comments + 1):
+            yield json.dumps({'type': 'comment', 'name': name,
+                'number': number, 'comment': _paragraphs(rnd, 1),
+                'author': 'user%02d' % rnd.randrange(num_authors),
+                'time': published + number * 600})
+
+def create_blog_env(path, posts=1000, versions=3, comments=5,
+                    attachments=1, seed=42):
+    """ Creates a Trac environment at path and fills it with blog data.
+    Returns the environment. """
+    env = Environment(path, create=True, options=[
+            ('project', 'name', 'FullBlog benchmark'),
+            ('trac', 'database', 'sqlite:db/trac.db'),
+            ('components', 'tracfullblog.*', 'enabled'),
+            ('logging', 'log_type', 'none')])
+    db = env.get_db_cnx()
+    FullBlogSetup(env).upgrade_environment(db)
+    db.commit()
+    PermissionSystem(env).grant_permission('anonymous', 'BLOG_VIEW')
+    import_blog(env, generate_lines(posts, versions, comments, seed))
+    if attachments:
+        # Attachment records only - the benchmarks never read the files
+        cursor = db.cursor()
+        rows = []
+        for i in xrange(posts):
+            for j in range(attachments):
+                rows.append(('blog', 'post-%07d' % i, 'file%d.txt' % j,
+                             1024, 0, '', 'user00', '127.0.0.1'))
+            if len(rows) >= 1000:
+                cursor.executemany("INSERT INTO attachment VALUES "
+                        "(%s, %s, %s, %s, %s, %s, %s, %s)", rows)
+                rows = []
+        if rows:
+            cursor.executemany("INSERT INTO attachment VALUES "
+                    "(%s, %s, %s, %s, %s, %s, %s, %s)", rows)
+        db.commit()
+    _create_macro_page(env)
+    return env
+
+# Internal functions
+
+def _paragraphs(rnd, count):
+    return '\n\n'.join([' '.join([rnd.choice(words) for i in range(60)])
+                        for j in range(count)])
+
+def _create_macro_page(env):
+    """ Wiki page used by the BlogListMacro benchmark. """
+    from trac.wiki.model import WikiPage
+    page = WikiPage(env, 'BlogListBenchmark')
+    page.text = "[[BlogList(recent=20, format=inline)]]\n\n" \
+                "[[BlogList(recent=10, format=full, max_size=250)]]\n\n" \
+                "[[BlogList(category=cat001, format=float)]]\n"
+    page.save('user00', 'Benchmark page', '127.0.0.1')
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] <envpath>")
+    parser.add_option('--posts', type='int', default=1000)
+    parser.add_option('--versions', type='int', default=3)
+    parser.add_option('--comments', type='int', default=5)
+    parser.add_option('--attachments', type='int', default=1)
+    parser.add_option('--seed', type='int', default=42)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Path for new environment is required.")
+    started = time.time()
+    create_blog_env(args[0], options.posts, options.versions,
+                    options.comments, options.attachments, options.seed)
+    print >> sys.stderr, "Created %s in %.1fs" % (args[0],
+                                                 time.time() - started)
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load test for the /blog handler.
+
+Serves a Trac environment from a local WSGI server using several forked
+worker processes (each with a pool of threads), and replays a weighted mix
+of anonymous reads, RSS polls, comment posts and post edits from a number
+of client threads. Reports throughput, p50/p99 latencies per action, error
+counts by kind (like duplicate keys from concurrent comment numbering)
+and the hit rate of the shared cache summed over all worker processes.
+
+    python -m benchmarks.loadtest --env /tmp/blogenv --duration 60
+    python -m benchmarks.loadtest --posts 5000 --processes 4 --threads 8 \\
+            --mix read=70,rss=15,comment=10,edit=5
+
+License: BSD
+"""
+
+import cookielib
+import multiprocessing
+import os
+import Queue
+import random
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from trac.env import open_environment
+from trac.perm import PermissionSystem
+from trac.web.main import dispatch_request
+
+from benchmarks.generator import create_blog_env
+
+__all__ = ['run_load_test']
+
+default_mix = 'read=70,rss=15,comment=10,edit=5'
+
+# Patterns used to classify server errors from the response body
+error_kinds = [
+    ('duplicate_key', re.compile(r'IntegrityError|UNIQUE constraint|'
+                                 r'not unique|duplicate key', re.I)),
+    ('locked', re.compile(r'database is locked', re.I)),
+    ('form_token', re.compile(r'form token', re.I)),
+    ]
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """ Threaded WSGI server limiting the number of concurrent requests. """
+    daemon_threads = True
+
+    def __init__(self, sock, port, threads):
+        WSGIServer.__init__(self, ('127.0.0.1', port), QuietHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = 'localhost'
+        self.server_port = port
+        self.setup_environ()
+        self.pool = threading.Semaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.acquire()
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            self.pool.release()
+
+
+def serve(sock, port, env_path, threads, stats_queue):
+    """ Worker process: serves requests until terminated, then reports the
+    cache counters of the process. """
+    from tracfullblog import cache
+    def application(environ, start_response):
+        environ['trac.env_path'] = env_path
+        return dispatch_request(environ, start_response)
+    def report(signum, frame):
+        stats_queue.put(cache.stats())
+        # Wait for the feeder thread to write the stats before exiting
+        stats_queue.close()
+        stats_queue.join_thread()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, report)
+    server = PooledWSGIServer(sock, port, threads)
+    server.set_app(application)
+    server.serve_forever()
+
+
+class Client(threading.Thread):
+    """ Replays random actions from the mix until the deadline. """
+
+    def __init__(self, base_url, names, mix, deadline, seed):
+        threading.Thread.__init__(self)
+        self.base_url = base_url
+        self.names = names
+        self.mix = mix
+        self.deadline = deadline
+        self.rnd = random.Random(seed)
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(self.cookies))
+        self.results = [] # (action, seconds, error_kind or None)
+
+    def run(self):
+        # Get a session cookie with form token before posting anything
+        self._request('/blog')
+        while time.time() < self.deadline:
+            action = self._pick()
+            started = time.time()
+            error = getattr(self, '_do_' + action)()
+            self.results.append((action, time.time() - started, error))
+
+    # Actions
+
+    def _do_read(self):
+        choice = self.rnd.random()
+        if choice < 0.4:
+            return self._request('/blog?page=%d' % self.rnd.randint(1, 5))
+        elif choice < 0.9:
+            return self._request('/blog/' + self.rnd.choice(self.names))
+        return self._request('/blog/archive')
+
+    def _do_rss(self):
+        return self._request('/blog?format=rss')
+
+    def _do_comment(self):
+        name = self.rnd.choice(self.names[:20]) # Contention on few posts
+        return self._request('/blog/' + name, {
+                'comment': 'Load test comment %f' % self.rnd.random(),
+                'author': 'loadtest', 'submitcomment': 'Add comment',
+                'action': 'comment'})
+
+    def _do_edit(self):
+        name = self.rnd.choice(self.names[:20])
+        return self._request('/blog/edit/' + name, {
+                'title': 'Edited %f' % self.rnd.random(),
+                'body': 'Body edited by load test %f' % self.rnd.random(),
+                'author': 'loadtest', 'categories': 'loadtest',
+                'new_version_comment': 'Load test', 'blog-save': 'Save',
+                'action': 'edit'})
+
+    # Internal methods
+
+    def _pick(self):
+        point = self.rnd.random() * sum([weight for action, weight
+                                         in self.mix])
+        for action, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return action
+        return self.mix[-1][0]
+
+    def _request(self, path, form=None):
+        """ Returns None on success, or the kind of error. """
+        data = None
+        if form is not None:
+            form = dict(form)
+            for cookie in self.cookies:
+                if cookie.name == 'trac_form_token':
+                    form['__FORM_TOKEN'] = cookie.value
+            data = urllib.urlencode(form)
+        try:
+            response = self.opener.open(self.base_url + path, data)
+            response.read()
+            return None
+        except urllib2.HTTPError, e:
+            body = e.read()
+            for kind, pattern in error_kinds:
+                if pattern.search(body):
+                    return kind
+            return 'http_%d' % e.code
+        except (urllib2.URLError, socket.error), e:
+            return 'connection'
+
+
+def run_load_test(env_path, processes=4, threads=8, clients=16,
+                  duration=30, mix=default_mix, port=0, out=sys.stdout):
+    """ Runs the load test and prints a report. Returns a dict with the
+    totals, per-action latencies, errors and cache counters. """
+    env = open_environment(env_path, use_cache=False)
+    perms = PermissionSystem(env)
+    granted = perms.get_user_permissions('anonymous')
+    for action in ['BLOG_VIEW', 'BLOG_COMMENT', 'BLOG_MODIFY_ALL']:
+        if not granted.get(action):
+            perms.grant_permission('anonymous', action)
+    cursor = env.get_db_cnx().cursor()
+    cursor.execute("SELECT DISTINCT name FROM fullblog_posts ORDER BY name")
+    names = [row[0] for row in cursor]
+    env.shutdown()
+    if not names:
+        raise ValueError("No blog posts in %s" % env_path)
+    mix = [(action, float(weight)) for action, weight
+           in [item.split('=') for item in mix.split(',')]]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    stats_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=serve,
+                    args=(sock, port, env_path, threads, stats_queue))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        deadline = time.time() + duration
+        started = time.time()
+        base_url = 'http://127.0.0.1:%d' % port
+        client_threads = [Client(base_url, names, mix, deadline, seed)
+                          for seed in range(clients)]
+        for client in client_threads:
+            client.start()
+        for client in client_threads:
+            client.join()
+        elapsed = time.time() - started
+    finally:
+        for worker in workers:
+            worker.terminate()
+        cache_stats = {'hits': 0, 'misses': 0}
+        for worker in workers:
+            worker.join()
+        for worker in workers:
+            try:
+                worker_stats = stats_queue.get(timeout=5)
+            except Queue.Empty:
+                break # A worker died without reporting
+            for key, value in worker_stats.items():
+                cache_stats[key] = cache_stats.get(key, 0) + value
+        sock.close()
+
+    results = []
+    for client in client_threads:
+        results.extend(client.results)
+    return _report(results, elapsed, cache_stats, out)
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _report(results, elapsed, cache_stats, out):
+    report = {'requests': len(results), 'seconds': elapsed,
+              'throughput': len(results) / max(elapsed, 1e-9),
+              'actions': {}, 'errors': {}, 'cache': cache_stats}
+    print >> out, "%d requests in %.1fs: %.1f requests/s" % (
+            report['requests'], elapsed, report['throughput'])
+    for action in sorted(set([result[0] for result in results])):
+        times = [seconds for name, seconds, error in results
+                 if name == action]
+        errors = len([error for name, seconds, error in results
+                      if name == action and error])
+        report['actions'][action] = {'count': len(times), 'errors': errors,
+                'p50': _percentile(times, 0.5), 'p99': _percentile(times, 0.99)}
+        print >> out, "  %-8s %6d requests  p50 %8.1f ms  p99 %8.1f ms  " \
+                "%5d errors" % (action, len(times),
+                _percentile(times, 0.5) * 1000,
+                _percentile(times, 0.99) * 1000, errors)
+    for name, seconds, error in results:
+        if error:
+            report['errors'][error] = report['errors'].get(error, 0) + 1
+    for kind, count in sorted(report['errors'].items()):
+        print >> out, "  error %-16s %6d" % (kind, count)
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    print >> out, "  cache hit rate %.1f%% (%d of %d lookups)" % (
+            lookups and 100.0 * cache_stats['hits'] / lookups or 0,
+            cache_stats['hits'], lookups)
+    return report
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--env', default=None,
+                      help="environment to test (default: generate one)")
+    parser.add_option('--posts', type='int', default=1000,
+                      help="posts in generated environment")
+    parser.add_option('--processes', type='int', default=4)
+    parser.add_option('--threads', type='int', default=8,
+                      help="threads per worker process")
+    parser.add_option('--clients', type='int', default=16,
+                      help="concurrent client threads")
+    parser.add_option('--duration', type='int', default=30,
+                      help="seconds to run")
+    parser.add_option('--mix', default=default_mix,
+                      help="weighted actions: read, rss, comment, edit")
+    parser.add_option('--port', type='int', default=0)
+    options, args = parser.parse_args()
+    env_path = options.env
+    generated = None
+    if not env_path:
+        generated = tempfile.mkdtemp(prefix='fullblog-load-')
+        shutil.rmtree(generated)
+        create_blog_env(generated, posts=options.posts).shutdown()
+        env_path = generated
+    try:
+        run_load_test(env_path, options.processes, options.threads,
+                      options.clients, options.duration, options.mix,
+                      options.port)
+    finally:
+        if generated:
+            shutil.rmtree(generated, ignore_errors=True)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the FullBlog plugin.
+
+For each size, a synthetic environment is generated (see generator.py) and
+every benchmark is run a number of times. For each benchmark the suite
+reports:
+ * queries - database statements executed per call
+ * seconds - best wall time per call
+ * maxrss_kb - growth of the process peak memory (resident set size)
+   during the benchmark
+Results can be saved as a JSON baseline, and compared with an earlier one.
+
+    python -m benchmarks.suite --sizes 1000,10000,100000 --baseline new.json
+    python -m benchmarks.suite --sizes 1000 --compare new.json
+
+License: BSD
+"""
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    # Python 2.5 compat
+    import simplejson as json
+
+from trac.db import util as db_util
+from trac.env import open_environment
+from trac.test import Mock, MockPerm
+from trac.web.href import Href
+from trac.web.main import dispatch_request
+
+from benchmarks.generator import create_blog_env
+
+__all__ = ['run_suite', 'compare']
+
+# Statement counter, shared by all cursors
+_queries = [0]
+
+
+def count_queries():
+    """ Patches the Trac cursor wrapper to count executed statements. """
+    if getattr(db_util.IterableCursor, '_fullblog_counting', False):
+        return
+    execute = db_util.IterableCursor.execute
+    executemany = db_util.IterableCursor.executemany
+    def counting_execute(self, *args, **kwargs):
+        _queries[0] += 1
+        return execute(self, *args, **kwargs)
+    def counting_executemany(self, *args, **kwargs):
+        _queries[0] += 1
+        return executemany(self, *args, **kwargs)
+    db_util.IterableCursor.execute = counting_execute
+    db_util.IterableCursor.executemany = counting_executemany
+    db_util.IterableCursor._fullblog_counting = True
+
+def wsgi_get(env, path, query=''):
+    """ Runs an anonymous GET request through the complete Trac WSGI
+    application, and returns the status line. """
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+               'QUERY_STRING': query, 'SCRIPT_NAME': '',
+               'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+               'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(''),
+               'wsgi.errors': sys.stderr, 'trac.env_path': env.path}
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+        return lambda data: None
+    for chunk in dispatch_request(environ, start_response):
+        pass
+    if not status[0].startswith('200'):
+        raise AssertionError("%s%s: %s" % (path, query and '?' + query,
+                                          status[0]))
+    return status[0]
+
+def mock_request(env):
+    """ Minimal request for calling provider methods directly. """
+    return Mock(authname='anonymous', perm=MockPerm(), args={},
+                href=Href('/'), abs_href=Href('http://localhost/'),
+                chrome={}, session={})
+
+def benchmarks(env, size):
+    """ Returns a list of (name, callable) benchmarks for an environment
+    generated with 'size' posts. """
+    from tracfullblog.core import FullBlogCore
+    from tracfullblog.web_ui import FullBlogModule
+    last_page = max(1, size // FullBlogModule(env).num_items)
+    items = [
+        ('front_page', lambda: wsgi_get(env, '/blog')),
+        ('deep_pagination', lambda: wsgi_get(env, '/blog',
+                                             'page=%d' % last_page)),
+        ('archive', lambda: wsgi_get(env, '/blog/archive')),
+        ('category_listing', lambda: wsgi_get(env, '/blog/category/cat001')),
+        ('author_listing', lambda: wsgi_get(env, '/blog/author/user01')),
+        ('post_view', lambda: wsgi_get(env, '/blog/post-%07d' % (size // 2))),
+        ('rss', lambda: wsgi_get(env, '/blog', 'format=rss')),
+        ('search', lambda: wsgi_get(env, '/search', 'q=cache+thread&blog=on')),
+        ('timeline', lambda: wsgi_get(env, '/timeline',
+                                      'daysback=90&blog=on')),
+        ('bloglist_macro', lambda: wsgi_get(env, '/wiki/BlogListBenchmark')),
+        ('months_authors_categories', lambda: FullBlogCore(env)
+                .get_months_authors_categories()),
+        ]
+    try:
+        from tracfullblog.tags import FullBlogTagSystem
+    except ImportError:
+        pass # Tags plugin not installed
+    else:
+        req = mock_request(env)
+        items.append(('tags_provider', lambda: list(
+                FullBlogTagSystem(env).get_tagged_resources(
+                                        req, ['cat001', 'cat002']))))
+    return items
+
+def run_benchmark(func, repeat):
+    """ Returns (queries, seconds, maxrss_kb) for the function: statements
+    and best time per call, and growth of peak memory over all calls. """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    queries = 0
+    for i in range(repeat):
+        _queries[0] = 0
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+        queries = _queries[0]
+        if best is None or elapsed < best:
+            best = elapsed
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return queries, best, rss_after - rss_before
+
+def run_suite(sizes, versions=3, comments=5, repeat=5, only=None,
+              workdir=None, keep=False, out=sys.stdout):
+    """ Runs the benchmarks for each size (number of posts). Returns the
+    results as {size: {benchmark: {'queries', 'seconds', 'maxrss_kb'}}}. """
+    count_queries()
+    results = {}
+    for size in sizes:
+        path = tempfile.mkdtemp(prefix='fullblog-bench-%d-' % size,
+                                dir=workdir)
+        shutil.rmtree(path)
+        try:
+            started = time.time()
+            create_blog_env(path, posts=size, versions=versions,
+                            comments=comments)
+            print >> out, "# %d posts generated in %.1fs" % (
+                            size, time.time() - started)
+            env = open_environment(path, use_cache=True)
+            results[str(size)] = size_results = {}
+            for name, func in benchmarks(env, size):
+                if only and name not in only:
+                    continue
+                func() # Warm-up call, not measured
+                queries, seconds, rss = run_benchmark(func, repeat)
+                size_results[name] = {'queries': queries,
+                                      'seconds': round(seconds, 6),
+                                      'maxrss_kb': rss}
+                print >> out, "%8d %-28s %6d queries %10.2f ms %8d kB" % (
+                                size, name, queries, seconds * 1000, rss)
+            env.shutdown()
+        finally:
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+    return results
+
+def compare(old, new, out=sys.stdout):
+    """ Prints changes between two result sets. Returns True if any
+    benchmark got slower by more than 10%, or runs more queries. """
+    regressed = False
+    for size in sorted(new, key=int):
+        for name in sorted(new[size]):
+            before = old.get(size, {}).get(name)
+            after = new[size][name]
+            if not before:
+                continue
+            ratio = after['seconds'] / max(before['seconds'], 1e-9)
+            flag = ''
+            if ratio > 1.1 or after['queries'] > before['queries']:
+                flag = ' REGRESSION'
+                regressed = True
+            print >> out, "%8s %-28s queries %5d -> %-5d time x%.2f%s" % (
+                    size, name, before['queries'], after['queries'],
+                    ratio, flag)
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help="comma-separated numbers of posts")
+    parser.add_option('--versions', type='int', default=3)
+    parser.add_option('--comments', type='int', default=5)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--only', default='',
+                      help="comma-separated benchmark names to run")
+    parser.add_option('--workdir', default=None,
+                      help="directory for generated environments")
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="keep generated environments")
+    parser.add_option('--baseline', default=None,
+                      help="save results as JSON to this file")
+    parser.add_option('--compare', default=None,
+                      help="compare results with this JSON baseline")
+    options, args = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',') if size]
+    only = [name for name in options.only.split(',') if name]
+    results = run_suite(sizes, options.versions, options.comments,
+                        options.repeat, only, options.workdir, options.keep)
+    if options.baseline:
+        out = open(options.baseline, 'w')
+        try:
+            json.dump(results, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+    if options.compare:
+        previous = json.load(open(options.compare))
+        if compare(previous, results):
+            sys.exit(1)
@@ -7,15 +7,23 @@ License: BSD
 (c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
+import sys
+
 from trac.core import *
-from trac.admin import IAdminPanelProvider
+from trac.admin import IAdminPanelProvider, IAdminCommandProvider
+from trac.admin.api import AdminCommandError
 from trac.resource import Resource
-from trac.web.chrome import add_warning
+from trac.util.text import printout, print_table
+from trac.web.chrome import add_warning, add_notice
 
 # Relative imports
+import cache
+from bulk import export_blog, import_blog, rebuild_derived
 from core import FullBlogCore
+from model import compact_post_storage, prune_post_versions
+from static import export_static
 
-__all__ = ['FullBlogAdminPanel']
+__all__ = ['FullBlogAdminPanel', 'FullBlogAdminCommands']
 
 class FullBlogAdminPanel(Component):
     """ Admin panel for settings related to FullBlog plugin. """
@@ -27,10 +35,17 @@ class FullBlogAdminPanel(Component):
     def get_admin_panels(self, req):
         if 'BLOG_ADMIN' in req.perm('blog'):
             yield ('blog', 'Blog', 'settings', 'Settings')
+            yield ('blog', 'Blog', 'versions', 'Version History')
+            yield ('blog', 'Blog', 'cache', 'Cache')
 
     def render_admin_panel(self, req, cat, page, path_info):     
         req.perm(Resource('blog', None)).require('BLOG_ADMIN')
 
+        if page == 'versions':
+            return self._render_versions_panel(req)
+        elif page == 'cache':
+            return self._render_cache_panel(req)
+
         blog_admin = {}
         blog_core = FullBlogCore(self.env)
         
@@ -41,6 +56,7 @@ class FullBlogAdminPanel(Component):
                 self.env.config.set('fullblog', 'default_postname',
                     req.args.get('defaultpostname'))
                 self.env.config.save()
+                blog_core.reset_settings()
             elif req.args.get('savebloginfotext'):
                 self.env.log.debug("New blog info text = %r" % req.args.get('bloginfotext'))
                 is_ok = blog_core.set_bloginfotext(
@@ -61,3 +77,277 @@ class FullBlogAdminPanel(Component):
         
         return ('fullblog_admin.html', {'blog_admin': blog_admin})
 
+    # Internal methods
+
+    def _render_cache_panel(self, req):
+        """ Panel with cache statistics, flush and warm-up. """
+        blog_core = FullBlogCore(self.env)
+        prefix = blog_core.get_cache_prefix()
+        store = blog_core.get_cache()
+        if req.method == "POST":
+            if req.args.get('flush'):
+                store.flush(prefix + req.args.get('name', ''))
+                add_notice(req, "Cache flushed.")
+            elif req.args.get('warm'):
+                warmed = blog_core.warm_cache()
+                add_notice(req, "Warmed %d cache items." % len(warmed))
+            elif req.args.get('resetstats'):
+                store.reset_stats()
+                add_notice(req, "Cache statistics cleared.")
+            req.redirect(req.href.admin(req.args['cat_id'],
+                                        req.args['panel_id']))
+        return ('fullblog_admin_cache.html',
+                {'blog_cache': cache_report(store, prefix)})
+
+    def _render_versions_panel(self, req):
+        """ Panel for pruning old versions of posts. """
+        policy = {'keep_last': 10, 'per_day': True, 'max_age': 0,
+                  'keep_timeline': True}
+        if req.method == "POST":
+            try:
+                policy['keep_last'] = int(req.args.get('keep_last') or 0)
+                policy['max_age'] = int(req.args.get('max_age') or 0)
+            except ValueError:
+                raise TracError("Number of versions and days must be integers.")
+            policy['per_day'] = bool(req.args.get('per_day'))
+            policy['keep_timeline'] = not req.args.get('drop_timeline')
+            if not (policy['keep_last'] or policy['per_day']
+                                        or policy['max_age']):
+                add_warning(req, "Select at least one rule for versions to keep.")
+            else:
+                dry_run = not req.args.get('prune')
+                num_posts, num_versions = prune_post_versions(self.env,
+                                            dry_run=dry_run, **policy)
+                if dry_run:
+                    add_notice(req, "%d versions of %d posts would be "
+                            "deleted." % (num_versions, num_posts))
+                else:
+                    rebuild_derived(self.env)
+                    add_notice(req, "Deleted %d versions of %d posts." % (
+                            num_versions, num_posts))
+        return ('fullblog_admin_versions.html', {'blog_policy': policy})
+
+
+
+def cache_report(store, prefix):
+    """ Returns statistics and entries of the values in store using prefix:
+        {'families': [(family, hits, misses, stale, hit_rate, avg_compute_ms)],
+         'entries': [(name, size, age, expires_in)]} """
+    families = []
+    for family, counters in sorted(store.family_stats().items()):
+        if not family.startswith(prefix):
+            continue
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        stale = counters.get('stale', 0)
+        lookups = hits + misses
+        hit_rate = lookups and 100.0 * (hits - stale) / lookups or 0.0
+        computes = counters.get('computes', 0)
+        compute_ms = computes and \
+                1000.0 * counters.get('compute_time', 0) / computes or 0.0
+        families.append((family[len(prefix):], hits, misses, stale,
+                         hit_rate, compute_ms))
+    entries = [(name[len(prefix):], size, int(age),
+                int(max(0, cache.MAX_AGE - age)))
+               for name, size, age in store.entries(prefix)]
+    return {'families': families, 'entries': entries}
+
+class FullBlogAdminCommands(Component):
+    """ trac-admin commands for managing FullBlog content. """
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('fullblog export', '<file>',
+               """Export all blog posts, versions and comments
+
+               Writes one JSON object per line to <file> (use '-' for
+               standard output). Posts are streamed with their full
+               version history, followed by all comments.""",
+               None, self._do_export)
+        yield ('fullblog import', '<file>',
+               """Import blog posts and comments from a JSON Lines file
+
+               Reads a file made by 'fullblog export' (use '-' for standard
+               input). Posts and comments in the file replace existing
+               posts and comments with the same name.""",
+               None, self._do_import)
+        yield ('fullblog export-static', '<directory> [incremental]',
+               """Render the blog as static files
+
+               Writes the front pages, archive, month, author and category
+               listings, all posts and the RSS feeds as anonymous user to
+               files in <directory> (see the static module for names). With
+               'incremental', only pages affected by changes since the last
+               export are written, and files of deleted posts are removed.""",
+               None, self._do_export_static)
+        yield ('fullblog dispatch', '',
+               """Deliver queued blog change events
+
+               Delivers all events queued for 'async' batch listeners when
+               [fullblog] deferred_dispatch is enabled.""",
+               None, self._do_dispatch)
+        yield ('fullblog compact-storage', '',
+               """Store bodies of old post versions by content hash
+
+               Moves bodies of all non-current post versions into a table
+               keyed by content hash, so identical bodies are stored once,
+               and removes stored bodies no longer in use. Used to convert
+               existing data after setting [fullblog] version_storage to
+               'dedup'.""",
+               None, self._do_compact_storage)
+        yield ('fullblog compact', '<rule> [rule] [...]',
+               """Delete old versions of blog posts
+
+               The current version is always kept. Other versions are kept
+               if matched by any of the rules:
+                 keep=N    - the N most recent versions of each post
+                 daily     - the most recent version of each day
+                 age=DAYS  - versions newer than DAYS days
+               Versions inside the default timeline period are also kept,
+               unless the 'timeline' argument is added. Add 'dry-run' to only
+               report what would be deleted.""",
+               None, self._do_compact)
+        yield ('fullblog cache list', '',
+               """Show cache statistics and entries
+
+               Shows hits, misses, stale reads and recompute times per cache
+               family (for all processes), and the size and age of each
+               cached value.""",
+               None, self._do_cache_list)
+        yield ('fullblog cache flush', '[name]',
+               """Remove cached values
+
+               Removes all cached values of the environment, or only those
+               with names starting with [name] (as shown by 'cache list').""",
+               None, self._do_cache_flush)
+        yield ('fullblog warm', '[seconds]',
+               """Warm caches after a restart or deploy
+
+               Loads the post index, computes the sidebar aggregates and
+               renders the first listing pages, feeds and recent posts as
+               an anonymous user. Stops after [seconds] (default is
+               [fullblog] warm_budget).""",
+               None, self._do_warm)
+
+    # Internal methods
+
+    def _do_export(self, filename):
+        if filename == '-':
+            out = sys.stdout
+        else:
+            try:
+                out = open(filename, 'w')
+            except IOError, e:
+                raise AdminCommandError("Cannot write %s: %s" % (filename, e))
+        try:
+            num_posts, num_comments = export_blog(self.env, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if out is not sys.stdout:
+            printout("Exported %d posts and %d comments to %s." % (
+                        num_posts, num_comments, filename))
+
+    def _do_import(self, filename):
+        if filename == '-':
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(filename, 'r')
+            except IOError, e:
+                raise AdminCommandError("Cannot read %s: %s" % (filename, e))
+        try:
+            try:
+                num_posts, num_comments = import_blog(self.env, lines)
+            except ValueError, e:
+                raise AdminCommandError("Import failed: %s" % e)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        printout("Imported %d posts and %d comments." % (
+                    num_posts, num_comments))
+
+    def _do_export_static(self, directory, mode=None):
+        if mode not in (None, 'incremental'):
+            raise AdminCommandError("Unknown argument '%s'." % mode)
+        written, removed = export_static(self.env, directory,
+                                         incremental=bool(mode))
+        printout("Wrote %d pages to %s, removed %d." % (written, directory,
+                                                         removed))
+
+    def _do_dispatch(self):
+        blog_core = FullBlogCore(self.env)
+        total = 0
+        while True:
+            delivered = blog_core.dispatch_deferred()
+            if not delivered:
+                break
+            total += delivered
+        printout("Delivered %d queued events." % total)
+
+    def _do_compact_storage(self):
+        moved, removed = compact_post_storage(self.env)
+        printout("Moved %d old versions to content storage, "
+                 "removed %d unused bodies." % (moved, removed))
+
+    def _do_compact(self, *rules):
+        policy = {'keep_last': 0, 'per_day': False, 'max_age': 0,
+                  'keep_timeline': True}
+        dry_run = False
+        for rule in rules:
+            key, value = (rule.split('=', 1) + [''])[:2]
+            try:
+                if key == 'keep':
+                    policy['keep_last'] = int(value)
+                elif key == 'age':
+                    policy['max_age'] = int(value)
+                elif key == 'daily':
+                    policy['per_day'] = True
+                elif key == 'timeline':
+                    policy['keep_timeline'] = False
+                elif key == 'dry-run':
+                    dry_run = True
+                else:
+                    raise AdminCommandError("Unknown rule '%s'." % rule)
+            except ValueError:
+                raise AdminCommandError("Invalid number in '%s'." % rule)
+        if not (policy['keep_last'] or policy['per_day'] or policy['max_age']):
+            raise AdminCommandError("At least one of the keep=N, daily "
+                                    "or age=DAYS rules is needed.")
+        num_posts, num_versions = prune_post_versions(self.env,
+                                        dry_run=dry_run, **policy)
+        if dry_run:
+            printout("Would delete %d versions of %d posts." % (
+                        num_versions, num_posts))
+        else:
+            rebuild_derived(self.env)
+            printout("Deleted %d versions of %d posts." % (
+                        num_versions, num_posts))
+
+    def _do_cache_list(self):
+        blog_core = FullBlogCore(self.env)
+        report = cache_report(blog_core.get_cache(),
+                              blog_core.get_cache_prefix())
+        print_table([(family, hits, misses, stale, '%.1f%%' % hit_rate,
+                      '%.1f' % compute_ms) for family, hits, misses, stale,
+                      hit_rate, compute_ms in report['families']],
+                    ['Family', 'Hits', 'Misses', 'Stale', 'Hit rate',
+                     'Compute ms'])
+        print_table(report['entries'],
+                    ['Name', 'Bytes', 'Age (s)', 'Expires in (s)'])
+
+    def _do_cache_flush(self, name=''):
+        blog_core = FullBlogCore(self.env)
+        blog_core.get_cache().flush(blog_core.get_cache_prefix() + name)
+
+    def _do_warm(self, seconds=None):
+        if seconds is not None:
+            try:
+                seconds = int(seconds)
+            except ValueError:
+                raise AdminCommandError("Seconds must be an integer.")
+        for item in FullBlogCore(self.env).warm_cache(seconds):
+            printout("Warmed %s" % item)
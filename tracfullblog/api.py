@@ -33,6 +33,29 @@ class IBlogChangeListener(Interface):
         number>0 denotes a specific comment is deleted, and fields will contain
             the values of the fields as they existed pre-delete."""
 
+class IBlogBatchChangeListener(Interface):
+    """Extension point interface for components that want blog changes
+    delivered as lists of events instead of one call per change.
+
+    Each event is a `(kind, postname, number, fields)` tuple, where `kind` is
+    one of 'post_changed', 'post_deleted', 'comment_added' or 'comment_deleted'
+    and `number`/`fields` have the same meaning as the arguments of the
+    corresponding `IBlogChangeListener` method (number is the version for posts).
+    """
+
+    def blog_change_delivery():
+        """Return 'sync' to get events inside the request that made the change,
+        or 'async' to get them later from the event queue. Async delivery
+        is only used if `[fullblog] deferred_dispatch` is enabled, otherwise
+        all events are delivered synchronously."""
+
+    def blog_changes(events):
+        """Called with a list of one or more events, oldest first.
+
+        Queued events are removed after all async listeners have returned.
+        If one raises an exception the events are delivered again later, to
+        all async listeners, so they must accept events seen before."""
+
 class IBlogManipulator(Interface):
     """Extension point interface for components that need to manipulate the content
     of blog posts and comments before insertion.
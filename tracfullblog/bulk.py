@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import and export of blog content using JSON Lines.
+
+Each line of the stream is a self-contained JSON object with a 'type' key:
+ * {"type": "post", "name": ..., "versions": [{...}, {...}]}
+ * {"type": "comment", "name": ..., "number": ..., "comment": ...,
+    "author": ..., "time": ...}
+ * {"type": "infotext", "text": ...}
+Times are stored as the integer timestamps used in the database.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+try:
+    import json
+except ImportError:
+    # Python 2.5 compat
+    import simplejson as json
+
+from core import FullBlogCore
+from model import compact_post_storage, rebuild_post_stats, \
+                  rebuild_post_tags, _body_hash, _bump_generation
+from static import reset_static_export
+
+__all__ = ['export_blog', 'import_blog', 'rebuild_derived']
+
+# Columns of fullblog_posts, in insert order
+post_columns = ['name', 'version', 'title', 'body', 'publish_time',
+                'version_time', 'version_comment', 'version_author',
+                'author', 'categories']
+
+# Columns of fullblog_comments, in insert order
+comment_columns = ['name', 'number', 'comment', 'author', 'time']
+
+# Number of rows passed to each executemany() call
+batch_rows = 1000
+
+# Number of rows inserted before the transaction is committed
+commit_rows = 20000
+
+
+def export_blog(env, out):
+    """ Writes all posts (with all versions), comments and the sidebar
+    info text to the file-like 'out' object. Rows are streamed from the
+    database cursor, so only one post is kept in memory at any time.
+    Returns a (num_posts, num_comments) tuple. """
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    num_posts = num_comments = 0
+    # Posts - consecutive rows with same name are versions of one post
+    cursor.execute("SELECT " + ", ".join(['p.' + column
+                                         for column in post_columns]) + ", "
+            "b.body FROM fullblog_posts p LEFT OUTER JOIN fullblog_blobs b "
+            "ON (p.body='' AND b.hash=p.body_hash) "
+            "ORDER BY p.name, p.version")
+    current = None
+    for row in cursor:
+        version = dict(zip(post_columns[1:], row[1:-1]))
+        if row[-1] is not None:
+            version['body'] = row[-1] # Body stored by content hash
+        if current and current['name'] == row[0]:
+            current['versions'].append(version)
+            continue
+        if current:
+            _write_line(out, current)
+            num_posts += 1
+        current = {'type': 'post', 'name': row[0], 'versions': [version]}
+    if current:
+        _write_line(out, current)
+        num_posts += 1
+    # Comments
+    cursor.execute("SELECT " + ", ".join(comment_columns) + " "
+            "FROM fullblog_comments ORDER BY name, number")
+    for row in cursor:
+        item = dict(zip(comment_columns, row))
+        item['type'] = 'comment'
+        _write_line(out, item)
+        num_comments += 1
+    # Sidebar info text
+    cursor.execute("SELECT value FROM system WHERE name='fullblog_infotext'")
+    for row in cursor:
+        _write_line(out, {'type': 'infotext', 'text': row[0]})
+    return num_posts, num_comments
+
+def import_blog(env, lines):
+    """ Imports content from an iterable of JSON lines (like an open file).
+    Posts and comments in the input replace any existing posts and comments
+    with the same name/number. Rows are inserted using batched executemany()
+    calls in large transactions, and derived data is rebuilt once after
+    all rows are inserted.
+    Returns a (num_posts, num_comments) tuple. Raises ValueError with the
+    line number for malformed lines. """
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    post_sql = "INSERT INTO fullblog_posts (" + ", ".join(post_columns) \
+               + ", body_hash) VALUES (" \
+               + ", ".join(['%s'] * (len(post_columns) + 1)) + ")"
+    comment_sql = "INSERT INTO fullblog_comments (" \
+               + ", ".join(comment_columns) + ") VALUES (" \
+               + ", ".join(['%s'] * len(comment_columns)) + ")"
+    post_names = []
+    post_rows = []
+    comment_keys = []
+    comment_rows = []
+    pending = [0]
+    num_posts = num_comments = 0
+
+    def flush(force=False):
+        if post_names:
+            cursor.executemany("DELETE FROM fullblog_posts WHERE name=%s",
+                    [(name,) for name in post_names])
+            del post_names[:]
+        if post_rows:
+            cursor.executemany(post_sql, post_rows)
+            pending[0] += len(post_rows)
+            del post_rows[:]
+        if comment_keys:
+            cursor.executemany("DELETE FROM fullblog_comments "
+                    "WHERE name=%s AND number=%s", comment_keys)
+            del comment_keys[:]
+        if comment_rows:
+            cursor.executemany(comment_sql, comment_rows)
+            pending[0] += len(comment_rows)
+            del comment_rows[:]
+        if force or pending[0] >= commit_rows:
+            cnx.commit()
+            pending[0] = 0
+
+    for lineno, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError, e:
+            raise ValueError("Line %d: %s" % (lineno + 1, e))
+        _check_keys(lineno + 1, item, ['type'])
+        kind = item.get('type')
+        if kind == 'post':
+            _check_keys(lineno + 1, item, ['name', 'versions'])
+            if not isinstance(item['versions'], list):
+                raise ValueError("Line %d: 'versions' is not a list" % (
+                            lineno + 1))
+            for version in item['versions']:
+                _check_keys(lineno + 1, version, ['version'])
+            post_names.append(item['name'])
+            for version in item['versions']:
+                version['name'] = item['name']
+                post_rows.append(tuple([version.get(column, u'')
+                                        for column in post_columns]
+                                       + [_body_hash(version.get('body', u''))]))
+            num_posts += 1
+        elif kind == 'comment':
+            _check_keys(lineno + 1, item, ['name', 'number'])
+            comment_keys.append((item['name'], item['number']))
+            comment_rows.append(tuple([item.get(column, u'')
+                                       for column in comment_columns]))
+            num_comments += 1
+        elif kind == 'infotext':
+            cursor.execute("UPDATE system SET value=%s "
+                    "WHERE name='fullblog_infotext'", (item.get('text', ''),))
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO system VALUES "
+                        "('fullblog_infotext', %s)", (item.get('text', ''),))
+        else:
+            raise ValueError("Line %d: Unknown type %r" % (lineno + 1, kind))
+        if len(post_rows) + len(comment_rows) >= batch_rows:
+            flush()
+    flush(force=True)
+    rebuild_derived(env)
+    return num_posts, num_comments
+
+def rebuild_derived(env):
+    """ Rebuilds data that is derived from posts and comments. Called once
+    after bulk changes instead of once per changed row. The next static
+    export is a full one, as the changed pages are not recorded. """
+    if env.config.get('fullblog', 'version_storage') == 'dedup':
+        compact_post_storage(env)
+    rebuild_post_tags(env)
+    rebuild_post_stats(env)
+    cnx = env.get_db_cnx()
+    _bump_generation(env, cnx.cursor())
+    cnx.commit()
+    blog_core = FullBlogCore(env)
+    blog_core.get_cache().flush(blog_core.get_cache_prefix())
+    reset_static_export(env)
+
+# Internal functions
+
+def _check_keys(lineno, item, keys):
+    """ Raises ValueError unless item is an object with all the keys. """
+    if not isinstance(item, dict):
+        raise ValueError("Line %d: Expected an object" % lineno)
+    missing = [key for key in keys if item.get(key) is None]
+    if missing:
+        raise ValueError("Line %d: Missing %s" % (lineno,
+                    ', '.join(["'%s'" % key for key in missing])))
+
+def _write_line(out, item):
+    out.write(json.dumps(item, ensure_ascii=True) + '\n')
@@ -2,70 +2,279 @@
 import datetime,time
 import fcntl
 import cPickle,os
+import tempfile
 
 #linux default save  in /dev/shm/
 
+# Seconds a cached value is considered valid
+MAX_AGE = 3600*23
+
+# Seconds between each merge of process counters into the shared stats file
+STATS_INTERVAL = 30
+
+# Seconds between listings of the values under a quota, when the sizes
+# written by the process since the last listing keep within the quota
+QUOTA_INTERVAL = 60
+
+STATS_FILE = '.fullblog_cache_stats'
+
+DEFAULT_DIR = '/dev/shm/'
+
+# One cache per directory, shared by all environments of the process
+_caches = {}
+
+
+def get_cache(save_dir=None):
+    """ Returns the cache storing values in save_dir (default /dev/shm).
+    The directory is created if needed. """
+    save_dir = os.path.join(save_dir or DEFAULT_DIR, '')
+    if not save_dir in _caches:
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        _caches[save_dir] = cache(save_dir)
+    return _caches[save_dir]
+
+def stats():
+    """ Returns the read counters of this process, for all directories. """
+    totals = {'hits': 0, 'misses': 0}
+    for store in _caches.values():
+        for key, value in store.stats().items():
+            totals[key] += value
+    return totals
+
 
 class cache(object):
-    store = {}   
-    SAVE_DIR='/dev/shm/'
-    
-    
-    def __call__(self,attrname,attrvalue=None): 
-        ret = self.get_set(attrname, attrvalue)        
+
+    def __init__(self, save_dir=DEFAULT_DIR):
+        self.SAVE_DIR = save_dir
+        # Maximum bytes of values stored for a name prefix: {prefix: bytes}
+        self.quotas = {}
+        # Bytes stored for a prefix when last listed, plus the bytes written
+        # by this process since: {prefix: (bytes, time_listed)}
+        self.sizes = {}
+        # Process-local counters not yet merged into the stats file:
+        # {family: {'hits': n, 'misses': n, 'stale': n,
+        #           'computes': n, 'compute_time': seconds}}
+        self.pending = {}
+        self.last_merge = time.time()
+        # Read counters for the life of this process
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self,attrname,attrvalue=None,family=None):
+        ret = self.get_set(attrname, attrvalue, family)
         return ret
-    def get_set(self, attrname,attrvalue):
+    def get_set(self, attrname,attrvalue,family=None):
         FILE_NAME=self.SAVE_DIR+str(attrname)
-        if  not attrvalue:
-#            print "not attrvalue!"
+        family = family or str(attrname)
+        if  attrvalue is None:
             if not self._checkTime(FILE_NAME):
-#                self.store[attrname] = {}                
-                os.remove(FILE_NAME)
-#                print "Time is over!"
+                try:
+                    os.remove(FILE_NAME)
+                except OSError:
+                    pass # Removed by another process
             try:
                 #get value
                 if os.path.exists(FILE_NAME):
-#                    print "Get "+str(attrname)+" value!"               
                     fp = open(FILE_NAME,'rb')
-#                    print "fp:",
-#                    print fp
-#                    fp.seek(0)
-                    
-                    self.store[attrname]=cPickle.load(fp)    
-#                    c=cPickle.load(fp)   
-#                    print "Get "+str(attrname)+" value done!"
-                    return self.store[attrname]
-#                    return c
+                    try:
+                        value = cPickle.load(fp)
+                    finally:
+                        fp.close()
+                    self._count(family, 'hits')
+                    return value
                 else:
-#                    print "os.path.exists is False!"
+                    self._count(family, 'misses')
                     return None
             except Exception, error:
-#                print "~~~~~~~~~~~~~~~~~"
                 print error
-#            except:     
-                return None               
-#                
-                
+                self._count(family, 'misses')
+                return None
         else:
-#            print "attrvalue is there! attrvalue: ...",
-#            print attrvalue
-            
-            self.store[attrname] = attrvalue
-            
-            #set value
-            
-            fp=open(FILE_NAME,'wrb')
-            fcntl.flock(fp,fcntl.LOCK_EX)
-            cPickle.dump(self.store[attrname], fp,0)
-#            print "dump "+str(attrname)+" to "+FILE_NAME+"!"
-            fcntl.flock(fp,fcntl.LOCK_UN)            
+            #set value - write to a temporary file and rename, so that
+            #readers never see a partial file. The temporary name is unique
+            #for each write, as threads of a process may write the same value
+            fd, tmp_name = tempfile.mkstemp(prefix=str(attrname) + '.',
+                                            suffix='.tmp', dir=self.SAVE_DIR)
+            fp = os.fdopen(fd, 'wb')
+            try:
+                try:
+                    fcntl.flock(fp,fcntl.LOCK_EX)
+                    cPickle.dump(attrvalue, fp,0)
+                    size = fp.tell()
+                    fcntl.flock(fp,fcntl.LOCK_UN)
+                finally:
+                    fp.close()
+                os.rename(tmp_name, FILE_NAME)
+            except:
+                try:
+                    os.remove(tmp_name)
+                except OSError:
+                    pass
+                raise
+            self._enforce_quotas(str(attrname), size)
             return attrvalue
-        
+
+    def set_quota(self, prefix, size):
+        """ Limits the values with names starting with prefix to size bytes
+        in total. The oldest values are removed when a write goes over the
+        quota. Writes by other processes are only seen when the values are
+        listed, at least every QUOTA_INTERVAL seconds, so the total can go
+        over the quota for that long. A size of 0 means no limit. """
+        if size:
+            self.quotas[prefix] = size
+        else:
+            self.quotas.pop(prefix, None)
+
+    def compute(self, attrname, func, family=None):
+        """ Calls func() to compute a value, stores it in the cache and
+        returns it. The time spent is recorded for the family. """
+        family = family or str(attrname)
+        started = time.time()
+        value = func()
+        self.computed(family, time.time() - started)
+        self(attrname, value, family)
+        return value
+
+    def computed(self, family, seconds):
+        """ Records that a value of the family was computed in seconds. """
+        self._count(family, 'computes')
+        self._count(family, 'compute_time', seconds)
+
+    def stale(self, family):
+        """ Records that a value was found, but could not be used as it
+        was made from outdated data. It is counted as a hit for reads. """
+        self._count(family, 'stale')
+
+    def stats(self):
+        """ Returns the read counters of this process as a dict. """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def family_stats(self):
+        """ Returns the counters per family for all processes, as a dict:
+            {family: {'hits', 'misses', 'stale', 'computes', 'compute_time'}}
+        Counters of the current process are merged before reading. """
+        self.merge_stats()
+        return self._read_stats()
+
+    def merge_stats(self):
+        """ Adds the counters of this process to the shared stats file. """
+        self.last_merge = time.time()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        path = self.SAVE_DIR + STATS_FILE
+        try:
+            fp = open(path, 'a+b')
+        except IOError:
+            return
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                totals = cPickle.load(fp)
+            except Exception:
+                totals = {}
+            for family, counters in pending.items():
+                family_totals = totals.setdefault(family, {})
+                for key, value in counters.items():
+                    family_totals[key] = family_totals.get(key, 0) + value
+            fp.seek(0)
+            fp.truncate()
+            cPickle.dump(totals, fp, 0)
+            fp.flush()
+            fcntl.flock(fp, fcntl.LOCK_UN)
+        finally:
+            fp.close()
+
+    def reset_stats(self):
+        """ Clears the counters of all processes. """
+        self.pending = {}
+        try:
+            os.remove(self.SAVE_DIR + STATS_FILE)
+        except OSError:
+            pass
+
+    def entries(self, prefix):
+        """ Returns a list of (name, size, age) for the cached values with
+        names starting with prefix. Size is in bytes, age in seconds. """
+        now = time.time()
+        entries = []
+        for filename in sorted(os.listdir(self.SAVE_DIR)):
+            if not filename.startswith(prefix) or filename.endswith('.tmp'):
+                continue
+            try:
+                info = os.stat(self.SAVE_DIR + filename)
+            except OSError:
+                continue # Removed by another process
+            entries.append((filename, info.st_size, now - info.st_mtime))
+        return entries
+
+    def flush(self, prefix):
+        """ Removes all cached values with names starting with prefix.
+        Values still being written (temporary files) are left alone. """
+        for filename in os.listdir(self.SAVE_DIR):
+            if filename.startswith(prefix) and not filename.endswith('.tmp'):
+                try:
+                    os.remove(self.SAVE_DIR + filename)
+                except OSError:
+                    pass # Removed by another process
+
+    def _enforce_quotas(self, attrname, size):
+        now = time.time()
+        for prefix, quota in self.quotas.items():
+            if not attrname.startswith(prefix):
+                continue
+            total, listed = self.sizes.get(prefix, (0, 0))
+            total += size
+            if total <= quota and now - listed < QUOTA_INTERVAL:
+                self.sizes[prefix] = (total, listed)
+                continue
+            entries = self.entries(prefix)
+            total = sum([entry[1] for entry in entries])
+            # Expired values first, then the oldest
+            entries.sort(key=lambda entry: (entry[2] < MAX_AGE, -entry[2]))
+            for name, entry_size, age in entries:
+                if total <= quota and age < MAX_AGE:
+                    break
+                if name == attrname:
+                    continue # Keep the value just written
+                try:
+                    os.remove(self.SAVE_DIR + name)
+                except OSError:
+                    pass # Removed by another process
+                total -= entry_size
+            self.sizes[prefix] = (total, now)
+
+    def _count(self, family, key, value=1):
+        if key == 'hits':
+            self.hits += 1
+        elif key == 'misses':
+            self.misses += 1
+        counters = self.pending.setdefault(family, {})
+        counters[key] = counters.get(key, 0) + value
+        if time.time() - self.last_merge > STATS_INTERVAL:
+            self.merge_stats()
+
+    def _read_stats(self):
+        try:
+            fp = open(self.SAVE_DIR + STATS_FILE, 'rb')
+        except IOError:
+            return {}
+        try:
+            fcntl.flock(fp, fcntl.LOCK_SH)
+            try:
+                return cPickle.load(fp)
+            except Exception:
+                return {}
+        finally:
+            fp.close()
+
     def _checkTime(self,filename):
         if os.path.exists(filename):
-            return (time.time() - 3600*23 < os.path.getmtime(filename) < time.time() + 3600*23)
+            return (time.time() - MAX_AGE < os.path.getmtime(filename) < time.time() + MAX_AGE)
         else:
             return True
 
 
-c = cache()
\ No newline at end of file
+c = get_cache()
@@ -10,27 +10,59 @@ License: BSD
 (c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
+import datetime
+import threading
+import time
+from hashlib import sha1
 from time import strftime
 
+try:
+    import json
+except ImportError:
+    # Python 2.5 compat
+    import simplejson as json
+
 from genshi.builder import tag
 
-from trac.attachment import ILegacyAttachmentPolicyDelegate
+from trac.attachment import IAttachmentChangeListener, \
+                            ILegacyAttachmentPolicyDelegate
 from trac.core import *
-from trac.config import Option
+from trac.config import Option, BoolOption, IntOption
 from trac.perm import IPermissionRequestor
-from trac.resource import IResourceManager
+from trac.resource import IResourceManager, Resource
 from trac.util.compat import sorted, set
-from trac.util.text import unicode_unquote
-from trac.util.datefmt import to_datetime, utc
+from trac.util.text import to_utf8, unicode_unquote
+from trac.util.datefmt import to_datetime, to_timestamp, utc
 from trac.wiki.api import IWikiSyntaxProvider
 
 # Relative imports (same package)
-from api import IBlogChangeListener, IBlogManipulator
-from model import BlogPost, get_blog_resources, get_blog_posts, get_all_blog_posts
-from util import parse_period
+from api import IBlogChangeListener, IBlogBatchChangeListener, IBlogManipulator
+from db import db_version
+from index import get_post_index
+from model import BlogPost, get_blog_resources, get_generation, \
+                  _bump_generation, _update_post_stats
+from util import map_month_names, parse_period
 
 import cache
 
+# Background threads delivering deferred events, per environment path:
+# {env.path: (env, thread)}
+_dispatch_workers = {}
+_dispatch_workers_lock = threading.Lock()
+
+# Seconds after which a claim on queued events is taken over
+event_claim_timeout = 600
+
+# Failed deliveries after which a queued event is no longer delivered
+event_max_attempts = 10
+
+# Environment paths that have started a warm-up thread in this process
+_warmed_envs = set()
+
+# Settings shown on every blog page, per environment path:
+# {env.path: (generation, config_mtime, settings)}
+_settings = {}
+
 class FullBlogCore(Component):
     """ Module implementing features that are common and shared
     between the various parts of the plugin. """
@@ -38,10 +70,11 @@ class FullBlogCore(Component):
     # Extensions
     
     listeners = ExtensionPoint(IBlogChangeListener)
+    batch_listeners = ExtensionPoint(IBlogBatchChangeListener)
     manipulators = ExtensionPoint(IBlogManipulator)
     
     implements(IPermissionRequestor, IWikiSyntaxProvider, IResourceManager,
-            ILegacyAttachmentPolicyDelegate)
+            ILegacyAttachmentPolicyDelegate, IAttachmentChangeListener)
 
     # Options
 
@@ -51,6 +84,79 @@ class FullBlogCore(Component):
         %m=month, %d=day, %H=hour, %M=minute, %S=second, $USER.
         Example template string: `%Y/%m/%d/my_topic`""")
 
+    BoolOption('fullblog', 'deferred_dispatch', False,
+        """Store change events in a queue table for batch listeners that
+        ask for 'async' delivery, instead of calling them during the
+        request. Queued events are delivered by a background thread (see
+        `deferred_worker`) or by `trac-admin <env> fullblog dispatch`.""")
+
+    BoolOption('fullblog', 'deferred_worker', True,
+        """Run a background thread in each process that delivers queued
+        events when `deferred_dispatch` is enabled. Disable to only deliver
+        them using `trac-admin`.""")
+
+    IntOption('fullblog', 'deferred_interval', 10,
+        """Seconds between each check of the event queue by the
+        background delivery thread.""")
+
+    Option('fullblog', 'version_storage', 'full',
+        """How bodies of old post versions are stored: 'full' keeps a
+        complete copy in every version, 'dedup' moves bodies of old versions
+        into a table keyed by content hash so identical bodies are stored
+        once. Existing data is converted using
+        `trac-admin <env> fullblog compact-storage`.""")
+
+    IntOption('fullblog', 'excerpt_size', 500,
+        """Maximum number of characters of a post shown in listings and
+        feeds, unless the post has a `[[more]]` line marking the end of its
+        excerpt. The excerpt ends at a paragraph, line or word break.""")
+
+    Option('fullblog', 'cache_dir', '/dev/shm',
+        """Directory for cached values shared between processes. It is
+        created if it does not exist.""")
+
+    Option('fullblog', 'cache_namespace', '',
+        """Name prefixing the cached values of this environment. Default
+        is derived from the environment path, so environments never read
+        each other's values. Set the same namespace for several paths
+        serving the same database to let them share cached values.""")
+
+    IntOption('fullblog', 'cache_quota', 10240,
+        """Maximum size in kB of the cached values of this environment.
+        The oldest values are removed when it is exceeded (0 = no
+        limit).""")
+
+    BoolOption('fullblog', 'warm_on_load', False,
+        """Warm the caches in a background thread when the plugin is
+        first loaded by a process (see `trac-admin <env> fullblog warm`).""")
+
+    IntOption('fullblog', 'warm_budget', 30,
+        """Maximum number of seconds spent warming caches. Remaining
+        steps are skipped when the time is used.""")
+
+    IntOption('fullblog', 'warm_pages', 3,
+        """Number of front page listing pages rendered by cache warm-up.""")
+
+    IntOption('fullblog', 'warm_feeds', 5,
+        """Number of category feeds (largest categories first) rendered by
+        cache warm-up, in addition to the main feed.""")
+
+    IntOption('fullblog', 'warm_posts', 10,
+        """Number of recent posts rendered by cache warm-up.""")
+
+    BoolOption('fullblog', 'count_views', True,
+        """Count the number of times each post is viewed, for showing the
+        most viewed posts. Views are counted in memory and written to the
+        database in batches.""")
+
+    IntOption('fullblog', 'view_flush_interval', 60,
+        """Seconds between each write of the counted views of a process
+        to the database. View counts are read back at the same interval.""")
+
+    IntOption('fullblog', 'view_flush_threshold', 100,
+        """Number of counted views that makes the request reaching it
+        write them to the database, without waiting for the interval.""")
+
     # Constants
 
     reserved_names = ['create', 'view', 'edit', 'delete',
@@ -59,6 +165,18 @@ class FullBlogCore(Component):
     def __init__(self):
         self.env.systeminfo.append(('FullBlog',
                 __import__('tracfullblog', ['__version__']).__version__))
+        if self.env.config.getbool('fullblog', 'deferred_dispatch') and \
+                self.env.config.getbool('fullblog', 'deferred_worker'):
+            self._start_dispatch_worker()
+        else:
+            self._stop_dispatch_worker()
+        if self.env.config.getbool('fullblog', 'warm_on_load') and \
+                not self.env.path in _warmed_envs:
+            _warmed_envs.add(self.env.path)
+            worker = threading.Thread(target=self._warm_in_background,
+                                      name='FullBlog cache warm-up')
+            worker.setDaemon(True)
+            worker.start()
 
     # IPermissionRequestor method
     
@@ -88,14 +206,30 @@ class FullBlogCore(Component):
                 if 'BLOG_MODIFY_ALL' in perm(resource.parent):
                     return True
                 elif 'BLOG_MODIFY_OWN' in perm(resource.parent):
-                    bp = BlogPost(self.env, resource.parent.id)
-                    if bp.author == username:
+                    info = self.get_post_info(resource.parent.id)
+                    if info and info[2] == username:
                         return True
                     else:
                         return False
                 else:
                     return False
 
+    # IAttachmentChangeListener methods
+
+    def attachment_added(self, attachment):
+        self._attachments_changed(attachment.parent_realm,
+                                  attachment.parent_id)
+
+    def attachment_deleted(self, attachment):
+        self._attachments_changed(attachment.parent_realm,
+                                  attachment.parent_id)
+
+    def attachment_reparented(self, attachment, old_parent_realm,
+                              old_parent_id):
+        self._attachments_changed(old_parent_realm, old_parent_id)
+        self._attachments_changed(attachment.parent_realm,
+                                  attachment.parent_id)
+
     # IResourceManager methods
     
     def get_resource_realms(self):
@@ -107,15 +241,19 @@ class FullBlogCore(Component):
         
     def get_resource_description(self, resource, format=None, context=None,
                                  **kwargs):
-        bp = BlogPost(self.env, resource.id, resource.version)
+        info = self.get_post_info(resource.id)
+        if info and resource.version and resource.version != info[0]:
+            # Title of an older version
+            info = (resource.version,
+                    BlogPost(self.env, resource.id, resource.version).title)
+        title = info and info[1] or ''
         if context:
-            return tag.a('Blog: '+bp.title, href=context.href.blog(resource.id))
+            return tag.a('Blog: '+title, href=context.href.blog(resource.id))
         else:
-            return 'Blog: '+bp.title
+            return 'Blog: '+title
 
     def resource_exists(self, resource):
-        bp = BlogPost(self.env, resource.id)
-        return len(bp.versions)
+        return self.get_post_info(resource.id) is not None
 
     # IWikiSyntaxProvider methods
 
@@ -146,25 +284,26 @@ class FullBlogCore(Component):
             else:
                 url = segments[0]
                 anchor = ''
-            return tag.a(label, href=(url and formatter.href.blog(url) or '') \
-                    + (anchor and '#' + anchor or ''))
+            href = (url and formatter.href.blog(url) or '') \
+                    + (anchor and '#' + anchor or '')
+            if not url:
+                return tag.a(label, href=href)
+            # Existence from the post index - no queries per link
+            info = self.get_post_info(url)
+            if info is None:
+                return tag.a(label, class_='missing blog', href=href,
+                             rel='nofollow')
+            if not 'BLOG_VIEW' in formatter.perm(Resource('blog', url)):
+                # Do not show the title of posts the user cannot view
+                return tag.a(label, class_='blog', href=href)
+            return tag.a(label, class_='blog', href=href,
+                         title='Blog: ' + info[1])
 
     # Utility methods used by other modules
     
     def get_bloginfotext(self):
-        """ Retrieves the blog info text in sidebar from database. """
-        try:
-            cnx = self.env.get_db_cnx()
-            cursor = cnx.cursor()
-            cursor.execute("SELECT value from system " \
-                "WHERE name='fullblog_infotext'")
-            rows = cursor.fetchall()
-            if rows:
-                return rows[0][0] # Only item in cursor (hopefully)
-            else:
-                return ''
-        except:
-            return ''
+        """ Retrieves the blog info text in sidebar (see get_settings()). """
+        return self.get_settings()['infotext']
 
     def set_bloginfotext(self, text=''):
         """ Stores the blog info text in the database. """
@@ -173,11 +312,129 @@ class FullBlogCore(Component):
             cursor = cnx.cursor()
             cursor.execute("UPDATE system set value=%s " \
                 "WHERE name=%s", (text, 'fullblog_infotext'))
+            # Pages showing the text are outdated in all processes
+            _bump_generation(self.env, cursor)
             cnx.commit()
+            self.reset_settings()
             return True
         except:
             return False
-    
+
+    def get_settings(self):
+        """ Returns a dict with the settings and content shown on every
+        blog page:
+         * 'about' - the BlogPost named 'about' (version 0 if none)
+         * 'infotext' - the blog info text in sidebar
+         * 'month_names' - list of the 12 month names
+         * 'personal_blog' - value of the `personal_blog` option
+         * 'num_items' - value of the `num_items_front` option
+        They are read once by each process, and again after changes to
+        posts or the info text, or a reload of the configuration.
+        The values are shared between requests and must not be changed. """
+        generation = get_generation(self.env, posts=True)
+        config_mtime = getattr(self.config, '_lastmtime', None)
+        cached = _settings.get(self.env.path)
+        if cached and cached[:2] == (generation, config_mtime):
+            return cached[2]
+        settings = {'about': BlogPost(self.env, 'about'),
+                    'infotext': self._fetch_bloginfotext(),
+                    'month_names': map_month_names(
+                            self.config.getlist('fullblog', 'month_names')),
+                    'personal_blog': self.config.getbool('fullblog',
+                                                         'personal_blog'),
+                    'num_items': self.config.getint('fullblog',
+                                                    'num_items_front')}
+        _settings[self.env.path] = (generation, config_mtime, settings)
+        return settings
+
+    def reset_settings(self):
+        """ Makes the next get_settings() read the settings again, after
+        changes made by this process. """
+        _settings.pop(self.env.path, None)
+
+    def get_post_info(self, name):
+        """ Returns (version, title, author) for the current version of a
+        post, or None if there is no such post. Answered from the post index,
+        which is reloaded when the blog changes. """
+        index = get_post_index(self.env)
+        position = index.position(name)
+        if position is not None:
+            return (index.versions[position], index.titles[position],
+                    index.author_names[index.authors[position]])
+
+    def get_related_posts(self, name, perm=None, limit=5):
+        """ Returns a list of (name, title) for up to 'limit' posts sharing
+        categories with the post, most shared categories first and then
+        newest first. If 'perm' is provided, posts the user cannot view are
+        skipped. """
+        index = get_post_index(self.env)
+        position = index.position(name)
+        if position is None:
+            return []
+        related = []
+        for p in index.related(position, limit * 2):
+            if perm and not 'BLOG_VIEW' in perm(Resource('blog',
+                                                         index.names[p])):
+                continue
+            related.append((index.names[p], index.titles[p]))
+        return related[:limit]
+
+    def get_cache(self):
+        """ Returns the cache for values of this environment, with the
+        quota of the environment applied. """
+        store = cache.get_cache(self.env.config.get('fullblog', 'cache_dir'))
+        store.set_quota(self.get_cache_prefix(),
+                self.env.config.getint('fullblog', 'cache_quota') * 1024)
+        return store
+
+    def get_cache_prefix(self):
+        """ Returns the prefix used for the names of all values this
+        environment stores in the shared cache. It includes the schema
+        version, so values from before an upgrade are never read. """
+        namespace = self.env.config.get('fullblog', 'cache_namespace') \
+                or sha1(to_utf8(self.env.path)).hexdigest()[:16]
+        return 'fullblog_%s_%d_' % (namespace, db_version)
+
+    def warm_cache(self, budget=None):
+        """ Computes the data that the first requests after a restart would
+        otherwise compute: the post index, the sidebar aggregates, and
+        anonymous renderings of the first listing pages, the main and
+        largest category feeds and the most recent posts. Steps run in that
+        order until 'budget' seconds (default from `warm_budget`) are used.
+        Returns a list of the items warmed. """
+        from offline import fetch_page
+        if budget is None:
+            budget = self.env.config.getint('fullblog', 'warm_budget')
+        deadline = time.time() + budget
+        config = self.env.config
+        warmed = []
+        index = get_post_index(self.env)
+        warmed.append('index')
+        self.get_months_authors_categories()
+        warmed.append('sidebar')
+        pages = [('/blog', '')]
+        pages += [('/blog', 'page=%d' % page) for page in
+                  range(2, config.getint('fullblog', 'warm_pages') + 1)]
+        pages.append(('/blog', 'format=rss'))
+        categories = sorted(index.aggregate(index.select())[2],
+                            key=lambda item: item[1], reverse=True)
+        pages += [('/blog/category/' + category, 'format=rss') for category, count
+                  in categories[:config.getint('fullblog', 'warm_feeds')]]
+        pages += [('/blog/' + name, '') for name in [index.names[p] for p
+                  in index.select()[:config.getint('fullblog', 'warm_posts')]]]
+        for path, query in pages:
+            if time.time() > deadline:
+                self.log.info("FullBlog: Cache warm-up stopped after %d "
+                        "seconds." % budget)
+                break
+            status = fetch_page(self.env, path, query)[0]
+            if status == 200:
+                warmed.append(path + (query and '?' + query or ''))
+            else:
+                self.log.debug("FullBlog: Warm-up of %s?%s returned %d" % (
+                        path, query, status))
+        return warmed
+
     def get_prev_next_posts(self, perm, post_name):
         """ Returns the name of the next and previous posts when compared with
         input 'post_name'. """
@@ -224,8 +481,7 @@ class FullBlogCore(Component):
             return warnings
         # All seems well - save and notify
         warnings.extend(bp.save(version_author, version_comment))
-        for listener in self.listeners:
-            listener.blog_post_changed(bp.name, bp.version)
+        self._notify([('post_changed', bp.name, bp.version, {})])
         return warnings
         
     def delete_post(self, bp, version=0):
@@ -245,10 +501,10 @@ class FullBlogCore(Component):
             warnings.append(('', "Unknown error. Not deleted."))
         if is_deleted:
             version = bp.get_versions() and fields['version'] or 0 # Any versions left?
-            for listener in self.listeners:
-                    listener.blog_post_deleted(bp.name, version, fields)
-                    if not version: # Also notify that all comments are deleted
-                        listener.blog_comment_deleted(bp.name, 0, {})
+            events = [('post_deleted', bp.name, version, fields)]
+            if not version: # Also notify that all comments are deleted
+                events.append(('comment_deleted', bp.name, 0, {}))
+            self._notify(events)
         return warnings
     
     def create_comment(self, req, bc, verify_only=False):
@@ -271,8 +527,7 @@ class FullBlogCore(Component):
         # No problems (we think), try to save.
         warnings.extend(bc.create())
         if not warnings:
-            for listener in self.listeners:
-                listener.blog_comment_added(bc.post_name, bc.number)
+            self._notify([('comment_added', bc.post_name, bc.number, {})])
         return warnings
     
     def delete_comment(self, bc):
@@ -286,9 +541,8 @@ class FullBlogCore(Component):
                   'time': bc.time}
         is_deleted = bc.delete()
         if is_deleted:
-            for listener in self.listeners:
-                listener.blog_comment_deleted(
-                        fields['post_name'], fields['number'], fields)
+            self._notify([('comment_deleted', fields['post_name'],
+                            fields['number'], fields)])
         else:
             warnings.append(('', "Unknown error. Not deleted."))
         return warnings
@@ -305,7 +559,7 @@ class FullBlogCore(Component):
         * If user and perm is provided, the list is also filtered for permissions.
         * Note also that it only fetches from most recent version. """
 #        cache_months_authors_categories= self.env.project_name + "_months_authors_categories"
-        cache_months_authors_categories = self.env.project_name + '_blog_posts_months'
+        cache_months_authors_categories = self.get_cache_prefix() + 'posts_months'
 #        if  user:
 #            cache_months_authors_categories += "_user_" + user
         if  from_dt:   
@@ -315,40 +569,195 @@ class FullBlogCore(Component):
              s_to_dt= str(to_dt)
              cache_months_authors_categories += s_to_dt.replace(" ", "").replace(":", "").replace("-", "").replace("+", "")       
             
-        if cache.c(cache_months_authors_categories):
+        family = self.get_cache_prefix() + 'sidebar'
+        generation = get_generation(self.env, posts=True)
+        store = self.get_cache()
+        cached = store(cache_months_authors_categories, family=family)
+        if cached and cached[0] == generation:
             self.env.log.debug("%r  found Cache ,return Cache...318......." % cache_months_authors_categories)       
-            return cache.c(cache_months_authors_categories)
+            return cached[1]
         else:
             self.env.log.debug("%r not found. Cacheing.. 322." % cache_months_authors_categories)
-            
-            blog_posts = get_all_blog_posts(self.env, from_dt=from_dt, to_dt=to_dt)
-            a_dict = {}
-            c_dict = {}
-            m_dict = {}
-            total = 0
-            for post in blog_posts:
+            if cached:
+                store.stale(family)
+
+            def compute():
+                index = get_post_index(self.env)
+                positions = index.select(from_dt=from_dt, to_dt=to_dt)
                 if user and perm:
                     # Check permissions
-                    bp = BlogPost(self.env, post[0], post[1])
-                    if not 'BLOG_VIEW' in perm(bp.resource):
-                        continue # Skip this post
-                post_time = post[2]
-                m_dict[(post_time.year, post_time.month)] = m_dict.get(
-                        (post_time.year, post_time.month), 0) + 1
-                author = post[3]
-                a_dict[author] = a_dict.get(author, 0) + 1
-                categories = post[6] # a list
-                for category in set(categories):
-                    c_dict[category] = c_dict.get(category, 0) + 1
-                total += 1
-            return cache.c(cache_months_authors_categories,([(m, m_dict.get(m, 0)) for m in sorted(m_dict.keys(), reverse=True)],
-                    [(a, a_dict.get(a, 0)) for a in sorted(a_dict.keys())],
-                    [(c, c_dict.get(c, 0)) for c in sorted(c_dict.keys())],
-                    total))
+                    positions = [p for p in positions if 'BLOG_VIEW' in
+                                    perm(Resource('blog', index.names[p]))]
+                return (generation, index.aggregate(positions))
+            return store.compute(cache_months_authors_categories, compute,
+                                   family)[1]
 #            return cache.months_authors_categories
 
+    def dispatch_deferred(self, limit=500):
+        """ Delivers up to 'limit' queued events to batch listeners that
+        asked for 'async' delivery. Events are claimed by setting their claim
+        time, so concurrent dispatchers will not deliver the same events,
+        and removed from the queue once all listeners have accepted them.
+        If a listener fails the claims are released and the events are
+        delivered again by a later call. Claims older than
+        'event_claim_timeout' seconds are taken over (dispatcher died), and
+        events that failed 'event_max_attempts' times are left in the queue
+        without being delivered.
+        Returns the number of events delivered. """
+        now = int(time.time())
+        cnx = self.env.get_db_cnx()
+        cursor = cnx.cursor()
+        cursor.execute("SELECT id, claimed, kind, name, number, fields "
+                "FROM fullblog_events WHERE claimed<%s AND attempts<%s "
+                "ORDER BY id LIMIT %s", (now - event_claim_timeout,
+                                         event_max_attempts, limit))
+        rows = cursor.fetchall()
+        ids = []
+        events = []
+        for id, claimed, kind, name, number, fields in rows:
+            cursor.execute("UPDATE fullblog_events SET claimed=%s "
+                    "WHERE id=%s AND claimed=%s", (now, id, claimed))
+            if cursor.rowcount == 0:
+                continue # Claimed by someone else
+            ids.append((id,))
+            events.append((kind, name, number, _decode_fields(fields)))
+        cnx.commit()
+        if not events:
+            return 0
+        try:
+            for listener in self._batch_listeners('async'):
+                listener.blog_changes(events)
+        except Exception, e:
+            self.log.error("FullBlog: Deferred delivery to %r failed, %d "
+                    "events kept for retry: %s" % (listener, len(events), e))
+            cursor.executemany("UPDATE fullblog_events SET claimed=0, "
+                    "attempts=attempts+1 WHERE id=%s", ids)
+            cnx.commit()
+            return 0
+        cursor.executemany("DELETE FROM fullblog_events WHERE id=%s", ids)
+        cnx.commit()
+        return len(events)
+
     # Internal methods
-    
+
+    def _fetch_bloginfotext(self):
+        """ Reads the blog info text in sidebar from the database. """
+        try:
+            cnx = self.env.get_db_cnx()
+            cursor = cnx.cursor()
+            cursor.execute("SELECT value from system " \
+                "WHERE name='fullblog_infotext'")
+            rows = cursor.fetchall()
+            if rows:
+                return rows[0][0] # Only item in cursor (hopefully)
+            else:
+                return ''
+        except:
+            return ''
+
+    def _attachments_changed(self, realm, post_name):
+        """ Updates the attachment count of a post. Posts being deleted
+        have their stats removed afterwards. Only the stored pages and lists
+        show the count, so they are removed from the shared cache instead of
+        changing the generation marker (and reloading post indexes). """
+        if realm != 'blog':
+            return
+        cnx = self.env.get_db_cnx()
+        cursor = cnx.cursor()
+        _update_post_stats(cursor, post_name)
+        cnx.commit()
+        prefix = self.get_cache_prefix()
+        store = self.get_cache()
+        store.flush(prefix + 'page_')
+        store.flush(prefix + 'macro_')
+
+    def _notify(self, events):
+        """ Delivers a list of (kind, name, number, fields) events to
+        regular listeners, synchronous batch listeners, and (if enabled)
+        stores them in the queue for asynchronous batch listeners. """
+        for kind, name, number, fields in events:
+            for listener in self.listeners:
+                if kind == 'post_changed':
+                    listener.blog_post_changed(name, number)
+                elif kind == 'post_deleted':
+                    listener.blog_post_deleted(name, number, fields)
+                elif kind == 'comment_added':
+                    listener.blog_comment_added(name, number)
+                elif kind == 'comment_deleted':
+                    listener.blog_comment_deleted(name, number, fields)
+        for listener in self._batch_listeners('sync'):
+            listener.blog_changes(events)
+        if self._batch_listeners('async'):
+            cnx = self.env.get_db_cnx()
+            cursor = cnx.cursor()
+            now = to_timestamp(datetime.datetime.now(utc))
+            cursor.executemany("INSERT INTO fullblog_events "
+                    "(time, kind, name, number, fields, claimed, attempts) "
+                    "VALUES (%s, %s, %s, %s, %s, 0, 0)",
+                    [(now, kind, name, number, _encode_fields(fields))
+                     for kind, name, number, fields in events])
+            cnx.commit()
+
+    def _batch_listeners(self, delivery):
+        """ Returns the batch listeners using the given delivery ('sync' or
+        'async'). Without deferred dispatch all listeners are 'sync'. """
+        deferred = self.env.config.getbool('fullblog', 'deferred_dispatch')
+        selected = []
+        for listener in self.batch_listeners:
+            mode = deferred and listener.blog_change_delivery() or 'sync'
+            if mode == delivery:
+                selected.append(listener)
+        return selected
+
+    def _start_dispatch_worker(self):
+        """ Starts the background thread delivering queued events, unless
+        one is already running for this environment object in this process.
+        A thread started for an earlier (reloaded) environment object with
+        the same path stops when the new one is registered. """
+        _dispatch_workers_lock.acquire()
+        try:
+            env, worker = _dispatch_workers.get(self.env.path, (None, None))
+            if env is self.env and worker.isAlive():
+                return
+            worker = threading.Thread(target=self._dispatch_loop,
+                                      name='FullBlog event dispatch')
+            worker.setDaemon(True)
+            _dispatch_workers[self.env.path] = (self.env, worker)
+            worker.start()
+        finally:
+            _dispatch_workers_lock.release()
+
+    def _stop_dispatch_worker(self):
+        """ Makes a running delivery thread for the environment path stop
+        (after the environment was reloaded with the worker disabled). """
+        _dispatch_workers_lock.acquire()
+        try:
+            _dispatch_workers.pop(self.env.path, None)
+        finally:
+            _dispatch_workers_lock.release()
+
+    def _dispatch_loop(self):
+        me = threading.currentThread()
+        while _dispatch_workers.get(self.env.path, (None, None))[1] is me:
+            time.sleep(max(1, self.env.config.getint('fullblog',
+                                                     'deferred_interval')))
+            if _dispatch_workers.get(self.env.path, (None, None))[1] \
+                    is not me:
+                break
+            try:
+                while self.dispatch_deferred():
+                    pass
+            except Exception, e:
+                self.log.error("FullBlog: Event dispatch failed: %s" % e)
+
+    def _warm_in_background(self):
+        time.sleep(1) # Let the environment finish loading
+        try:
+            warmed = self.warm_cache()
+            self.log.info("FullBlog: Warmed %d cache items." % len(warmed))
+        except Exception, e:
+            self.log.error("FullBlog: Cache warm-up failed: %s" % e)
+
     def _get_default_postname(self, user=''):
         """ Parses and returns the setting for default_postname. """
         opt = self.env.config.get('fullblog', 'default_postname')
@@ -386,3 +795,27 @@ class FullBlogCore(Component):
                 "'%s' is seen as a time period, and cannot "
                 "be used as a name. Please change." % name))        
         return warnings
+
+
+# Internal functions
+
+def _encode_fields(fields):
+    """ Serializes a fields dict of an event for the queue table,
+    keeping datetime and set values. """
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return {'__datetime__': to_timestamp(value)}
+        if isinstance(value, (set, frozenset)):
+            return {'__set__': sorted(value)}
+        raise TypeError(repr(value))
+    return json.dumps(fields, default=default)
+
+def _decode_fields(text):
+    """ Reverse of _encode_fields(). """
+    def object_hook(value):
+        if '__datetime__' in value:
+            return to_datetime(value['__datetime__'], utc)
+        if '__set__' in value:
+            return set(value['__set__'])
+        return value
+    return json.loads(text or '{}', object_hook=object_hook)
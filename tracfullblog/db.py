@@ -14,7 +14,7 @@ from trac.env import IEnvironmentSetupParticipant
 __all__ = ['FullBlogSetup']
 
 # Database version identifier for upgrades.
-db_version = 2
+db_version = 12
 
 # Database schema
 schema = [
@@ -30,6 +30,9 @@ schema = [
         Column('version_author'),
         Column('author'),
         Column('categories'),
+        Column('body_hash'),
+        Column('excerpt'),
+        Column('excerpt_html'), # No longer used
         Index(['version_time'])],
     # Blog comments
     Table('fullblog_comments', key=('name', 'number'))[
@@ -39,6 +42,39 @@ schema = [
         Column('author'),
         Column('time', type='int'),
         Index(['time'])],
+    # Queue of blog change events for deferred listener delivery
+    Table('fullblog_events', key='id')[
+        Column('id', auto_increment=True),
+        Column('time', type='int'),
+        Column('kind'),
+        Column('name'),
+        Column('number', type='int'),
+        Column('fields'),
+        Column('claimed', type='int'),
+        Column('attempts', type='int')],
+    # Bodies of old post versions, stored once per content hash
+    Table('fullblog_blobs', key='hash')[
+        Column('hash'),
+        Column('body')],
+    # Categories of the current version of each post
+    Table('fullblog_tags', key=('name', 'tag'))[
+        Column('name'),
+        Column('tag'),
+        Index(['tag'])],
+    # Comment and attachment counts per post
+    Table('fullblog_post_stats', key='name')[
+        Column('name'),
+        Column('comment_count', type='int'),
+        Column('last_comment_time', type='int'),
+        Column('attachment_count', type='int')],
+    # Number of times each post has been viewed
+    Table('fullblog_views', key='name')[
+        Column('name'),
+        Column('views', type='int')],
+    # Pages changed since the last static export
+    Table('fullblog_static_changes', key='path')[
+        Column('path'),
+        Column('time', type='int')],
 ]
 
 # Create tables
@@ -59,6 +95,18 @@ def create_tables(env, db):
     cursor.execute("INSERT into system values ('fullblog_version', %s)",
                         str(db_version))
     cursor.execute("INSERT into system values ('fullblog_infotext', '')")
+    cursor.execute("INSERT into system values ('fullblog_generation', '')")
+    cursor.execute(
+        "INSERT into system values ('fullblog_posts_generation', '')")
+
+def create_table(env, db, name):
+    """ Creates a single table from the schema, used by upgrades that
+    add new tables. """
+    cursor = db.cursor()
+    for table in schema:
+        if table.name == name:
+            for stmt in to_sql(env, table):
+                cursor.execute(stmt)
 
 # Upgrades
 
@@ -70,8 +118,85 @@ def add_timeline_time_indexes(env, db):
     cursor.execute(
         "CREATE INDEX fullblog_posts_version_time_idx ON fullblog_posts (version_time)")
 
+def add_event_queue(env, db):
+    """ Add the table used for deferred delivery of change events, with
+    the columns it had in this version (see add_event_claims()). """
+    table = Table('fullblog_events', key='id')[
+        Column('id', auto_increment=True),
+        Column('time', type='int'),
+        Column('kind'),
+        Column('name'),
+        Column('number', type='int'),
+        Column('fields')]
+    cursor = db.cursor()
+    for stmt in to_sql(env, table):
+        cursor.execute(stmt)
+
+def add_body_blobs(env, db):
+    """ Add body hash column to posts and the table for deduplicated
+    bodies of old versions. """
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE fullblog_posts ADD COLUMN body_hash text")
+    create_table(env, db, 'fullblog_blobs')
+
+def add_generation(env, db):
+    """ Add the generation marker that changes with every blog change. """
+    cursor = db.cursor()
+    cursor.execute("INSERT into system values ('fullblog_generation', '')")
+
+def add_static_changes(env, db):
+    """ Add the table tracking pages to update in static exports. """
+    create_table(env, db, 'fullblog_static_changes')
+
+def add_post_excerpts(env, db):
+    """ Add columns for the excerpt of posts and its rendered HTML. """
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE fullblog_posts ADD COLUMN excerpt text")
+    cursor.execute("ALTER TABLE fullblog_posts ADD COLUMN excerpt_html text")
+
+def add_tags(env, db):
+    """ Add the table of post categories, and fill it. """
+    from model import _fill_tags
+    create_table(env, db, 'fullblog_tags')
+    _fill_tags(db.cursor())
+
+def add_post_stats(env, db):
+    """ Add the table of comment and attachment counts, and fill it. """
+    from model import _fill_post_stats
+    create_table(env, db, 'fullblog_post_stats')
+    _fill_post_stats(db.cursor())
+
+def add_views(env, db):
+    """ Add the table of post view counts. """
+    create_table(env, db, 'fullblog_views')
+
+def add_event_claims(env, db):
+    """ Add claim time and failed attempts to queued events, so they are
+    only removed after delivery. """
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE fullblog_events ADD COLUMN claimed integer")
+    cursor.execute("ALTER TABLE fullblog_events ADD COLUMN attempts integer")
+    cursor.execute("UPDATE fullblog_events SET claimed=0, attempts=0")
+
+def add_posts_generation(env, db):
+    """ Add the generation marker that only changes with posts, so that
+    comments do not make processes reload their post index. """
+    cursor = db.cursor()
+    cursor.execute(
+        "INSERT into system values ('fullblog_posts_generation', '')")
+
 upgrade_map = {
-        2: add_timeline_time_indexes
+        2: add_timeline_time_indexes,
+        3: add_event_queue,
+        4: add_body_blobs,
+        5: add_generation,
+        6: add_static_changes,
+        7: add_post_excerpts,
+        8: add_tags,
+        9: add_post_stats,
+        10: add_views,
+        11: add_event_claims,
+        12: add_posts_generation,
     }
 
 # Component that deals with database setup
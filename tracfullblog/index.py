@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide in-memory index of current blog post versions.
+
+The index keeps one column per field instead of one object per post:
+ * times are packed in arrays of ints (timestamps)
+ * authors are interned and stored as ids
+ * categories are interned, and stored as a bitset per post
+Listing, month, author, category and count queries are answered by scanning
+these columns, without SQL or per-post object creation.
+
+Related posts are found through an inverted index from category to posts,
+built when first needed. Rankings are kept per post until a post sharing
+one of its categories changes categories or publish time.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+import threading
+from array import array
+
+from trac.core import *
+from trac.util.datefmt import to_datetime, to_timestamp, utc
+
+from api import IBlogChangeListener
+from model import PostSummary, get_generation, _last_bump, _parse_categories
+
+__all__ = ['PostIndex', 'get_post_index', 'FullBlogIndexUpdater']
+
+# Loaded indexes per environment path
+_indexes = {}
+_indexes_lock = threading.RLock()
+
+
+def get_post_index(env):
+    """ Returns the post index for the environment, (re)loading it if it is
+    missing or outdated compared to the posts generation marker. Changes to
+    comments do not change that marker. """
+    generation = get_generation(env, posts=True)
+    _indexes_lock.acquire()
+    try:
+        index = _indexes.get(env.path)
+        if index is None or index.generation != generation:
+            index = PostIndex()
+            index.load(env)
+            index.generation = generation
+            _indexes[env.path] = index
+        return index
+    finally:
+        _indexes_lock.release()
+
+
+class PostIndex(object):
+    """ Columnar index of the current version of all posts. Positions are
+    stable for the life of the index; deleted posts get version 0. """
+
+    def __init__(self):
+        self.generation = None
+        self.names = []
+        self.titles = []
+        self.versions = array('l')
+        self.publish_times = array('l')
+        self.version_times = array('l')
+        self.months = array('l')        # year * 12 + month - 1
+        self.authors = array('l')       # ids into author_names
+        self.categories = []            # bitsets of ids into category_names
+        self.author_names = []
+        self.category_names = []
+        self._author_ids = {}
+        self._category_ids = {}
+        self._positions = {}
+        self._order = {}                # sorted positions, per time column
+        self._members = None            # positions, per category id
+        self._related = {}              # (limit, ranked related positions)
+        self._bit_ids = {}              # category ids, per bitset
+
+    def load(self, env):
+        """ Loads the current version of all posts in one query. """
+        cnx = env.get_db_cnx()
+        cursor = cnx.cursor()
+        cursor.execute("SELECT bp1.name, bp1.version, bp1.title, "
+                "bp1.publish_time, bp1.version_time, bp1.author, "
+                "bp1.categories FROM fullblog_posts bp1, "
+                "(SELECT name, max(version) AS ver FROM fullblog_posts "
+                "GROUP BY name) bp2 "
+                "WHERE bp1.name = bp2.name AND bp1.version = bp2.ver")
+        for row in cursor:
+            self._set_row(row)
+
+    def update(self, env, name):
+        """ Reloads a single post from the database (after a change). """
+        cnx = env.get_db_cnx()
+        cursor = cnx.cursor()
+        cursor.execute("SELECT name, version, title, publish_time, "
+                "version_time, author, categories FROM fullblog_posts "
+                "WHERE name=%s ORDER BY version DESC LIMIT 1", (name,))
+        row = cursor.fetchone()
+        position = self._positions.get(name)
+        before = position is not None and (self.versions[position] and
+                self.categories[position], self.publish_times[position])
+        if row:
+            self._set_row(row)
+            position = self._positions[name]
+        elif position is not None:
+            self.versions[position] = 0
+        after = position is not None and (self.versions[position] and
+                self.categories[position], self.publish_times[position])
+        self._order = {}
+        if before != after:
+            self._forget_related(position, (before and before[0] or 0) |
+                                           (after and after[0] or 0))
+
+    # Queries
+
+    def select(self, category='', author='', from_dt=None, to_dt=None,
+               order='publish_time'):
+        """ Returns positions of posts matching all given criteria, newest
+        first by 'order' ('publish_time' or 'version_time'). Time limits
+        apply to the publish_time, and are exclusive like get_blog_posts(). """
+        positions = self._ordered(order)
+        if category:
+            cid = self._category_ids.get(category)
+            if cid is None:
+                return []
+            bit = 1 << cid
+            categories = self.categories
+            positions = [p for p in positions if categories[p] & bit]
+        if author:
+            aid = self._author_ids.get(author)
+            if aid is None:
+                return []
+            authors = self.authors
+            positions = [p for p in positions if authors[p] == aid]
+        if from_dt or to_dt:
+            times = self.publish_times
+            low = from_dt and to_timestamp(from_dt) or None
+            high = to_dt and to_timestamp(to_dt) or None
+            if low is not None:
+                positions = [p for p in positions if times[p] > low]
+            if high is not None:
+                positions = [p for p in positions if times[p] < high]
+        return positions
+
+    def position(self, name):
+        """ Returns the position of a current post, or None. """
+        position = self._positions.get(name)
+        if position is not None and self.versions[position]:
+            return position
+
+    def count(self, **criteria):
+        """ Returns number of posts matching criteria (see select()). """
+        return len(self.select(**criteria))
+
+    def aggregate(self, positions):
+        """ Returns (months, authors, categories, total) for the positions,
+        in the format of FullBlogCore.get_months_authors_categories(). """
+        m_dict = {}
+        a_dict = {}
+        b_dict = {}
+        months, authors, categories = self.months, self.authors, self.categories
+        for p in positions:
+            m_dict[months[p]] = m_dict.get(months[p], 0) + 1
+            a_dict[authors[p]] = a_dict.get(authors[p], 0) + 1
+            b_dict[categories[p]] = b_dict.get(categories[p], 0) + 1
+        c_count = [0] * len(self.category_names)
+        for bits, count in b_dict.items():
+            for cid in self._ids(bits):
+                c_count[cid] += count
+        return ([((m // 12, m % 12 + 1), m_dict[m])
+                        for m in sorted(m_dict, reverse=True)],
+                sorted([(self.author_names[a], count)
+                        for a, count in a_dict.items()]),
+                sorted([(self.category_names[c], count)
+                        for c, count in enumerate(c_count) if count]),
+                len(positions))
+
+    def summaries(self, positions):
+        """ Returns posts as PostSummary rows like get_blog_posts(), but
+        without the body:
+            (name, version, time, author, title, u'', category_list) """
+        return [PostSummary(self.names[p], self.versions[p],
+                            to_datetime(self.publish_times[p], utc),
+                            self.author_names[self.authors[p]],
+                            self.titles[p], u'', self.category_list(p))
+                for p in positions]
+
+    def category_list(self, position):
+        """ Returns the list of category names for a post position. """
+        names = self.category_names
+        return [names[cid] for cid in self._ids(self.categories[position])]
+
+    def related(self, position, limit=5):
+        """ Returns positions of up to 'limit' other posts sharing
+        categories with the post, ranked by number of shared categories and
+        then newest published first. """
+        stored = self._related.get(position)
+        if stored is None or stored[0] < limit:
+            stored = (limit, self._rank_related(position, limit))
+            self._related[position] = stored
+        return stored[1][:limit]
+
+    # Internal methods
+
+    def _rank_related(self, position, limit):
+        if self._members is None:
+            members = [[] for name in self.category_names]
+            versions, categories = self.versions, self.categories
+            for p in xrange(len(self.names)):
+                for cid in self._ids(versions[p] and categories[p]):
+                    members[cid].append(p)
+            self._members = members
+        shared = {}
+        for cid in self._ids(self.categories[position]):
+            for p in self._members[cid]:
+                shared[p] = shared.get(p, 0) + 1
+        shared.pop(position, None)
+        times = self.publish_times
+        return sorted(shared, key=lambda p: (shared[p], times[p]),
+                      reverse=True)[:limit]
+
+    def _forget_related(self, position, bits):
+        """ Drops the rankings of the post and of posts sharing any of the
+        categories in 'bits', after the post changed them. """
+        self._members = None
+        self._related.pop(position, None)
+        categories = self.categories
+        for p in self._related.keys():
+            if categories[p] & bits:
+                del self._related[p]
+
+    def _ids(self, bits):
+        """ Category ids set in a bitset. Posts share few distinct sets of
+        categories, so the ids are found once for each. """
+        ids = self._bit_ids.get(bits)
+        if ids is None:
+            ids, rest, cid = [], bits, 0
+            while rest:
+                if rest & 1:
+                    ids.append(cid)
+                rest >>= 1
+                cid += 1
+            self._bit_ids[bits] = ids
+        return ids
+
+    def _ordered(self, column):
+        """ Positions of existing posts sorted newest first by column. """
+        if not column in self._order:
+            times = getattr(self, column + 's')
+            versions = self.versions
+            positions = [p for p in xrange(len(self.names)) if versions[p]]
+            positions.sort(key=times.__getitem__, reverse=True)
+            self._order[column] = positions
+        return self._order[column]
+
+    def _intern(self, value, ids, names):
+        if not value in ids:
+            ids[value] = len(names)
+            names.append(value)
+        return ids[value]
+
+    def _set_row(self, row):
+        name, version, title, publish_time, version_time, author, \
+                categories = row
+        bits = 0
+        for category in set(_parse_categories(categories or '')):
+            bits |= 1 << self._intern(category, self._category_ids,
+                                      self.category_names)
+        published = to_datetime(publish_time, utc)
+        values = (version, publish_time, version_time,
+                  published.year * 12 + published.month - 1,
+                  self._intern(author, self._author_ids, self.author_names))
+        position = self._positions.get(name)
+        if position is None:
+            self._positions[name] = len(self.names)
+            self.names.append(name)
+            self.titles.append(title)
+            self.categories.append(bits)
+            for column, value in zip(self._int_columns(), values):
+                column.append(value)
+        else:
+            self.titles[position] = title
+            self.categories[position] = bits
+            for column, value in zip(self._int_columns(), values):
+                column[position] = value
+
+    def _int_columns(self):
+        return (self.versions, self.publish_times, self.version_times,
+                self.months, self.authors)
+
+
+class FullBlogIndexUpdater(Component):
+    """ Keeps the in-memory post index of this process up to date with
+    changes made in the process, without reloading the full index. Comments
+    are not indexed. """
+
+    implements(IBlogChangeListener)
+
+    # IBlogChangeListener methods
+
+    def blog_post_changed(self, postname, version):
+        self._update(postname)
+
+    def blog_post_deleted(self, postname, version, fields):
+        self._update(postname)
+
+    def blog_comment_added(self, postname, number):
+        pass
+
+    def blog_comment_deleted(self, postname, number, fields):
+        pass
+
+    # Internal methods
+
+    def _update(self, postname):
+        """ Updates the post in place if the index was current when the
+        post was changed. Otherwise changes by other processes are missing,
+        and the index is dropped to be reloaded on next use. """
+        previous, generation = _last_bump(self.env)
+        _indexes_lock.acquire()
+        try:
+            index = _indexes.get(self.env.path)
+            if index is None:
+                return
+            if index.generation == previous and \
+                    generation == get_generation(self.env, posts=True):
+                index.update(self.env, postname)
+                index.generation = generation
+            else:
+                del _indexes[self.env.path]
+        finally:
+            _indexes_lock.release()
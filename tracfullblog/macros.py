@@ -7,15 +7,24 @@ License: BSD
 (c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
+from hashlib import sha1
+
 from genshi.builder import tag
+from genshi.core import Markup
 
 from trac.core import TracError
-from trac.web.chrome import add_stylesheet, Chrome
+from trac.perm import PermissionSystem
+from trac.resource import Resource
+from trac.util.text import to_utf8
+from trac.web.chrome import add_link, add_stylesheet, Chrome
 from trac.wiki.api import parse_args
 from trac.wiki.macros import WikiMacroBase
 
-from model import get_blog_posts, BlogPost,get_all_blog_posts
+from core import FullBlogCore
+from index import get_post_index
+from model import BlogPost, get_generation
 from util import parse_period
+from views import get_view_counts
 
 class BlogListMacro(WikiMacroBase):
     """A macro to display list of posts and extracts outside (or inside)
@@ -35,6 +44,7 @@ class BlogListMacro(WikiMacroBase):
      * `format=` - type of display (see below for details)
      * `max_size=` - max. number of characters to render for each post
      * `meta=` - use `=off` to hide date, author and categories (default 'on')
+     * `sort=` - use `=popular` to order by number of views (default newest first)
 
     Example showing some available named arguments:
     {{{
@@ -58,7 +68,13 @@ class BlogListMacro(WikiMacroBase):
     
     The arguments can appear in any order.
     
-    Posts are rendered sorted by newest first for all modes.
+    Posts are rendered sorted by newest first for all modes, unless
+    `sort=popular` is used. Posts with the same number of views are then
+    sorted newest first.
+
+    The rendered list is cached until the blog changes, separately for each
+    argument list and user. Stylesheets and scripts added by macros in the
+    posts are added to the page again when the cached list is used.
     """
     
     def expand_macro(self, formatter, name, content):
@@ -73,68 +89,128 @@ class BlogListMacro(WikiMacroBase):
         heading = args_dict.get('heading', '')
         max_size = int(args_dict.get('max_size', 0))
         show_meta = args_dict.get('meta', '') != 'off' and True or False
+        sort = args_dict.get('sort', '').lower()
+        if format not in ['inline', 'full', 'float']:
+            raise TracError("Invalid 'format' argument used for macro %s." % name)
 
         # Get blog posts
-        all_posts = get_blog_posts(self.env, author=author, category=category,
-                        from_dt=from_dt, to_dt=to_dt)
+        index = get_post_index(self.env)
+        positions = index.select(category=category, author=author,
+                        from_dt=from_dt, to_dt=to_dt, order='version_time')
+        if sort == 'popular':
+            counts = get_view_counts(self.env)[0]
+            names = index.names
+            positions = sorted(positions,
+                    key=lambda p: counts.get(names[p], 0), reverse=True)
 
         # Trim posts against permissions and count
-        post_list = []
-        post_instances = []
         if format in ['float', 'full']:
             recent = recent or self.env.config.getint('fullblog', 'num_items_front')
-        recent = recent or len(all_posts)
-        count = 0
-        for post in all_posts:
-            if count == recent:
+        recent = recent or len(positions)
+        allowed = []
+        for position in positions:
+            if len(allowed) == recent:
                 break
-            bp = BlogPost(self.env, post[0])
-            if 'BLOG_VIEW' in formatter.req.perm(bp.resource):
-                count += 1
-                post_instances.append(bp)
-                post_list.append(post)
+            if 'BLOG_VIEW' in formatter.req.perm(Resource('blog',
+                                                index.names[position])):
+                allowed.append(position)
 
         # Rendering
         add_stylesheet(formatter.req, 'tracfullblog/css/fullblog.css')
         add_stylesheet(formatter.req, 'common/css/code.css')
 
-        if format == 'inline':
+        blog_core = FullBlogCore(self.env)
+        store = blog_core.get_cache()
+        prefix = blog_core.get_cache_prefix()
+        key = prefix + 'macro_' + self._fingerprint(formatter.req, content,
+                                    [index.names[p] for p in allowed])
+        family = prefix + 'macros'
+        generation = get_generation(self.env)
+        cached = store(key, family=family)
+        if cached and cached[0] == generation:
+            _replay_chrome(formatter.req, cached[2])
+            return Markup(cached[1])
+        if cached:
+            store.stale(family)
+
+        def compute():
             data = {'heading': heading,
-                    'posts': post_list,
                     'blog_personal_blog': self.config.getbool(
                                                 'fullblog', 'personal_blog'),
-                    'show_meta': show_meta,
-                    'execute_blog_macro': True}
-            return Chrome(self.env).render_template(formatter.req,
-                    'fullblog_macro_monthlist.html', data=data, fragment=True)
-
-        elif format == 'full':
-            return self._render_full_format(formatter, post_list,
-                                post_instances, heading, max_size, show_meta)
-
-        elif format == 'float':
-            # Essentially a 'full' list - just wrapped inside a new div
-            return tag.div(self._render_full_format(formatter, post_list,
-                                post_instances, heading, max_size, show_meta),
-                            class_="blogflash")
-
-        else:
-            raise TracError("Invalid 'format' argument used for macro %s." % name)
+                    'show_meta': show_meta}
+            if format == 'inline':
+                data['posts'] = index.summaries(allowed)
+                data['execute_blog_macro'] = True
+                template = 'fullblog_macro_monthlist.html'
+            else:
+                data['posts'] = [BlogPost(self.env, index.names[p],
+                                          index.versions[p]) for p in allowed]
+                if max_size:
+                    data['blog_max_size'] = max_size
+                template = 'fullblog_macro_list.html'
+            before = _chrome_additions(formatter.req)
+            html = Chrome(self.env).render_template(formatter.req, template,
+                    data=data, fragment=True).render('xhtml', encoding=None)
+            if format == 'float':
+                # Essentially a 'full' list - just wrapped inside a new div
+                html = unicode(tag.div(Markup(html), class_="blogflash"))
+            # Stylesheets and scripts added by macros in the posts
+            after = _chrome_additions(formatter.req)
+            added = (after[0][len(before[0]):], after[1][len(before[1]):])
+            return (generation, html, added)
+        return Markup(store.compute(key, compute, family)[1])
+
+    def _fingerprint(self, req, content, names):
+        """ Returns a digest of what the rendered list depends on besides
+        the posts themselves: the arguments, the posts the user may see,
+        the user and its permissions (for content rendered from wiki text,
+        like `$USER` or links checked by resource policies), and the time
+        zone and links of the request. Lists are therefore cached per user.
+        Changes to fine-grained permissions on other resources are seen
+        when the blog changes. """
+        perms = PermissionSystem(self.env).get_user_permissions(req.authname)
+        parts = [content or u'', req.authname, u'\n'.join(names),
+                 u' '.join(sorted([action for action, granted
+                                   in perms.items() if granted])),
+                 unicode(getattr(req, 'tz', '')),
+                 unicode(getattr(req, 'locale', '')), req.href()]
+        return sha1(to_utf8(u'\0'.join(parts))).hexdigest()
+
+
+def _chrome_additions(req):
+    """ Returns (stylesheets, scripts) added to the request so far, as
+    lists of (href, mimetype). """
+    chrome = getattr(req, 'chrome', {})
+    return ([(link.get('href'), link.get('type')) for link in
+             chrome.get('links', {}).get('stylesheet', [])],
+            [(script.get('href'), script.get('type')) for script in
+             chrome.get('scripts', [])])
+
+def _replay_chrome(req, added):
+    """ Adds the stylesheets and scripts recorded when a cached list was
+    rendered, as the macros in its posts are not run again. """
+    stylesheets, scripts = added
+    for href, mimetype in stylesheets:
+        add_link(req, 'stylesheet', href, mimetype=mimetype)
+    existing = req.chrome.setdefault('scripts', [])
+    hrefs = set([script.get('href') for script in existing])
+    for href, mimetype in scripts:
+        if not href in hrefs:
+            existing.append({'href': href, 'type': mimetype})
+            hrefs.add(href)
+
+
+class MoreMacro(WikiMacroBase):
+    """Marks the end of the excerpt of a blog post. The text before the
+    marker is shown in listings and feeds, with a link to the full post.
+    {{{
+    [[more]]
+    }}}
+    The marker must be on a line by itself. It renders as an empty anchor.
+    """
 
-    def _render_full_format(self, formatter, post_list, post_instances, heading,
-                                    max_size, show_meta):
-        """ Renters full blog posts. """
-        out = tag.div(class_="blog")
-        out.append(tag.div(heading, class_="blog-list-title"))
-        for post in post_instances:
-            data = {'post': post,
-                    'blog_personal_blog': self.config.getbool(
-                                                'fullblog', 'personal_blog'),
-                    'list_mode': True,
-                    'show_meta': show_meta,
-                    'execute_blog_macro': True}
-            if max_size:
-                data['blog_max_size'] = max_size
-            out.append(Chrome(self.env).render_template(formatter.req,
-                'fullblog_macro_post.html', data=data, fragment=True))
-        return out
+    def get_macros(self):
+        yield 'more'
+
+    def expand_macro(self, formatter, name, content):
+        return tag.span(id='more')
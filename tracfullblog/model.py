@@ -10,6 +10,7 @@ License: BSD
 """
 
 import datetime,time
+from hashlib import sha1
 from trac.attachment import Attachment
 from trac.resource import Resource
 from trac.search import search_to_sql
@@ -18,6 +19,7 @@ from trac.util.datefmt import to_datetime, to_timestamp, utc
 
 import cache
 import os
+from util import make_excerpt
 
 try:
     from trac.util.compat import itemgetter
@@ -27,17 +29,32 @@ except ImportError:
     from operator import itemgetter
 
 
-__all__ = ['BlogComment', 'BlogPost',
+__all__ = ['BlogComment', 'BlogPost', 'PostSummary', 'CommentRow',
            'search_blog_posts', 'search_blog_comments',
            'get_blog_posts', 'get_all_blog_posts', 'get_blog_comments',
-           'group_posts_by_month', 'get_blog_resources']
+           'get_recent_blog_comments',
+           'group_posts_by_month', 'get_blog_resources',
+           'compact_post_storage', 'prune_post_versions',
+           'rebuild_post_tags', 'rebuild_post_stats',
+           'get_generation']
+
+# Seconds a process trusts its last read of the generation marker
+generation_check_interval = 5
+
+# Last known generations per environment:
+#     {env.path: ((generation, posts_generation), time_read)}
+_generations = {}
+
+# Posts generation before and after the last change made by this process:
+#     {env.path: (previous, generation)}
+_bumped = {}
 
 # Public functions
 
 def search_blog_posts(env, terms):
     """ Free text search for content of blog posts.
     Input is a list of terms.
-    Returns a list of tuples with:
+    Returns a list of PostMatch rows, that also work as tuples of:
         (name, version, publish_time, author, title, body) """
     assert terms
     cnx = env.get_db_cnx()
@@ -47,7 +64,7 @@ def search_blog_posts(env, terms):
                'bp1.author', 'bp1.categories']
     search_clause, args = search_to_sql(cnx, columns, terms)
     sql = "SELECT bp1.name, bp1.version, bp1.publish_time, bp1.author, " \
-               "bp1.title, bp1.body " \
+               "bp1.title, bp1.body, bp1.categories " \
                "FROM fullblog_posts bp1," \
                "(SELECT name, max(version) AS ver " \
                "FROM fullblog_posts GROUP BY name) bp2 " \
@@ -56,13 +73,12 @@ def search_blog_posts(env, terms):
     env.log.debug("search_blog_posts() SQL: %r" % sql)
     cursor.execute(sql, args)
     # Return the items we have found
-    return [(row[0], row[1], to_datetime(row[2], utc), row[3],
-            row[4], row[5]) for row in cursor]
+    return [PostMatch.from_row(row) for row in cursor]
 
 def search_blog_comments(env, terms):
     """ Free text search for content of blog posts.
     Input is a list of terms.
-    Returns a list of tuples with:
+    Returns a list of CommentRow rows, that also work as tuples of:
         (post_name, comment_number, comment, comment_author, comment_time) """
     assert terms
     cnx = env.get_db_cnx()
@@ -75,8 +91,7 @@ def search_blog_comments(env, terms):
     env.log.debug("search_blog_comments() SQL: %r" % sql)
     cursor.execute(sql, args)
     # Return the items we have found
-    return [(row[0], row[1], row[2], row[3], to_datetime(row[4], utc))
-            for row in cursor]
+    return [CommentRow.from_row(row) for row in cursor]
 
 
 def get_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
@@ -95,7 +110,7 @@ def get_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
     Note: For datetime criteria the 'publish_time' is the default field searched,
     but if all_versions is requested the 'version_time' is used instead.
     
-    Returns a list of tuples of the form:
+    Returns a list of PostSummary rows, that also work as tuples of:
         (name, version, time, author, title, body, category_list)
     Use 'name' and 'version' to instantiate BlogPost objects."""
 
@@ -136,13 +151,12 @@ def get_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
     # Return the rows
     blog_posts = []
     for row in cursor:
+        post = PostSummary.from_row(row)
         # Extra check needed to weed out almost-matches where requested
         # category is a substring of another (searched using LIKE)
-        categories = _parse_categories(row[6])
-        if category and category not in categories:
+        if category and category not in post.categories:
             continue
-        blog_posts.append((row[0], row[1], to_datetime(row[2], utc), row[3],
-                row[4], row[5], categories))
+        blog_posts.append(post)
     
     return blog_posts
 
@@ -161,7 +175,7 @@ def get_all_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
     Note: For datetime criteria the 'publish_time' is the default field searched,
     but if all_versions is requested the 'version_time' is used instead.
     
-    Returns a list of tuples of the form:
+    Returns a list of PostSummary rows, that also work as tuples of:
         (name, version, time, author, title, body, category_list)
     Use 'name' and 'version' to instantiate BlogPost objects."""
     
@@ -235,19 +249,19 @@ def get_all_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
     
     blog_posts = []
     for row in cursor:
+        post = PostSummary.from_row(row)
         # Extra check needed to weed out almost-matches where requested
         # category is a substring of another (searched using LIKE)
-        categories = _parse_categories(row[6])
-        if category and category not in categories:
+        if category and category not in post.categories:
             continue
-        blog_posts.append((row[0], row[1], to_datetime(row[2], utc), row[3],
-                row[4], row[5], categories))
+        blog_posts.append(post)
 #        print "cache_blog_posts set new value!"
     return blog_posts
 
 def get_blog_comments(env, post_name='', from_dt=None, to_dt=None):
-    """ Returns comments as a list of tuples from search based on
-    AND input for post_name, and datetime span (from_dt and to_dt):
+    """ Returns comments as a list of CommentRow rows from search based
+    on AND input for post_name, and datetime span (from_dt and to_dt). They
+    also work as tuples of:
         (post_name, number, comment, author, time) 
     Instantiate BlogComment objects to get further details of each.
     Example of sorting the output by time, newest first:
@@ -275,8 +289,25 @@ def get_blog_comments(env, post_name='', from_dt=None, to_dt=None):
     cursor.execute(sql, where_values or None)
 
     # Return the items we have found
-    return [(row[0], row[1], row[2], row[3], to_datetime(row[4], utc))
-            for row in cursor]
+    return [CommentRow.from_row(row) for row in cursor]
+
+def get_recent_blog_comments(env, post_name='', since=0, limit=20,
+                             offset=0):
+    """ Returns up to 'limit' comments, newest first, skipping 'offset'
+    comments. The rows are the same as for get_blog_comments(). Use
+    post_name to only get comments for one post, and since (a timestamp) to
+    only get comments added after that time. """
+    sql = "SELECT name, number, comment, author, time " \
+          "FROM fullblog_comments WHERE time>%s"
+    args = [since]
+    if post_name:
+        sql += " AND name=%s"
+        args.append(post_name)
+    sql += " ORDER BY time DESC LIMIT %s OFFSET %s"
+    args += [limit, offset]
+    cursor = env.get_db_cnx().cursor()
+    cursor.execute(sql, args)
+    return [CommentRow.from_row(row) for row in cursor]
 
 def get_blog_resources(env):
     """ Returns a list of resource instances of existing blog posts (current
@@ -291,6 +322,132 @@ def get_blog_resources(env):
     blog_realm = Resource('blog')
     return [blog_realm(id=post[0], version=0) for post in cursor]
 
+def compact_post_storage(env, batch_size=500):
+    """ Moves the bodies of all old (non-current) post versions into the
+    content-addressed blob table, so that identical bodies are stored once.
+    Current versions keep their body inline. Unused blobs are removed.
+    Commits for every 'batch_size' posts processed.
+    Returns a (num_versions_moved, num_blobs_removed) tuple. """
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    cursor.execute("SELECT name, max(version) FROM fullblog_posts "
+            "GROUP BY name ORDER BY name")
+    latest = cursor.fetchall()
+    moved = 0
+    for index, (name, last_version) in enumerate(latest):
+        _internalize_body(cursor, name, last_version)
+        cursor.execute("SELECT version FROM fullblog_posts "
+                "WHERE name=%s AND version<%s AND body!=''",
+                (name, last_version))
+        for version in [row[0] for row in cursor.fetchall()]:
+            _externalize_body(cursor, name, version)
+            moved += 1
+        if (index + 1) % batch_size == 0:
+            cnx.commit()
+    removed = _remove_unused_blobs(cursor)
+    cnx.commit()
+    return moved, removed
+
+def prune_post_versions(env, keep_last=0, per_day=False, max_age=0,
+                        keep_timeline=True, dry_run=False, batch_size=500):
+    """ Deletes old versions of posts according to a policy. The current
+    version of a post is never deleted. Other versions are kept if matched
+    by any of the rules:
+     * keep_last - the N most recent versions
+     * per_day - the most recent version of each day (UTC)
+     * max_age - versions newer than N days (0 = no age rule)
+     * keep_timeline - versions inside the default timeline period
+       ('[timeline] default_daysback'), unless False
+    Versions are deleted in batched transactions, committing for every
+    'batch_size' posts. With dry_run nothing is deleted.
+    Returns a (num_posts, num_versions) tuple of what was (or would be) pruned.
+    """
+    now = to_timestamp(datetime.datetime.now(utc))
+    keep_after = []
+    if max_age:
+        keep_after.append(now - max_age * 86400)
+    if keep_timeline:
+        daysback = env.config.getint('timeline', 'default_daysback', 30)
+        keep_after.append(now - daysback * 86400)
+    keep_after = keep_after and min(keep_after) or None
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    cursor.execute("SELECT name FROM fullblog_posts "
+            "GROUP BY name HAVING count(*) > 1 ORDER BY name")
+    names = [row[0] for row in cursor.fetchall()]
+    num_posts = num_versions = 0
+    for index, name in enumerate(names):
+        cursor.execute("SELECT version, version_time FROM fullblog_posts "
+                "WHERE name=%s ORDER BY version DESC", (name,))
+        versions = cursor.fetchall()
+        keep = set([versions[0][0]]) # Current version
+        keep.update([version for version, vtime in versions[:keep_last]])
+        if keep_after is not None:
+            keep.update([version for version, vtime in versions
+                         if vtime > keep_after])
+        if per_day:
+            days = set()
+            for version, vtime in versions:
+                day = vtime // 86400
+                if not day in days:
+                    days.add(day)
+                    keep.add(version)
+        drop = [(name, version) for version, vtime in versions
+                if not version in keep]
+        if not drop:
+            continue
+        num_posts += 1
+        num_versions += len(drop)
+        if dry_run:
+            continue
+        env.log.debug("Pruning %d versions of blog post %r" % (
+                len(drop), name))
+        cursor.executemany("DELETE FROM fullblog_posts "
+                "WHERE name=%s AND version=%s", drop)
+        if (index + 1) % batch_size == 0:
+            cnx.commit()
+    if not dry_run:
+        _remove_unused_blobs(cursor)
+        _bump_generation(env, cursor)
+        cnx.commit()
+    return num_posts, num_versions
+
+def rebuild_post_tags(env):
+    """ Rebuilds the table of categories of current posts, used after
+    changes made directly in the database (like imports). """
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    cursor.execute("DELETE FROM fullblog_tags")
+    _fill_tags(cursor)
+    cnx.commit()
+
+def rebuild_post_stats(env):
+    """ Rebuilds the comment and attachment counts of all posts. """
+    cnx = env.get_db_cnx()
+    cursor = cnx.cursor()
+    cursor.execute("DELETE FROM fullblog_post_stats")
+    _fill_post_stats(cursor)
+    cnx.commit()
+
+def get_generation(env, posts=False):
+    """ Returns the generation marker of the blog, a string that changes
+    with every change to posts or comments in any process. With 'posts'
+    the marker returned only changes with posts and blog settings, not with
+    comments. Changes made by the current process are seen at once, changes
+    made by other processes within 'generation_check_interval' seconds. """
+    generations, checked = _generations.get(env.path, (None, 0))
+    if generations is None or \
+            time.time() - checked >= generation_check_interval:
+        cnx = env.get_db_cnx()
+        cursor = cnx.cursor()
+        cursor.execute("SELECT name, value FROM system WHERE name IN "
+                "('fullblog_generation', 'fullblog_posts_generation')")
+        values = dict(cursor.fetchall())
+        generations = (values.get('fullblog_generation') or '',
+                       values.get('fullblog_posts_generation') or '')
+        _generations[env.path] = (generations, time.time())
+    return generations[posts and 1 or 0]
+
 # Utility functions
 
 def group_posts_by_month(posts):
@@ -324,7 +481,143 @@ def group_posts_by_month(posts):
     return grouped_list
 
 # Internal functions
-    
+
+def _body_hash(body):
+    """ Returns the content hash used as key for stored bodies. """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return sha1(body).hexdigest()
+
+def _externalize_body(cursor, name, version):
+    """ Moves the body of a post version into the blob table (if not
+    already there), leaving an empty body and the hash in the post row. """
+    cursor.execute("SELECT body, body_hash FROM fullblog_posts "
+            "WHERE name=%s AND version=%s", (name, version))
+    row = cursor.fetchone()
+    if not row or not row[0]:
+        return # No such version, or already moved
+    body, body_hash = row[0], row[1] or _body_hash(row[0])
+    cursor.execute("SELECT 1 FROM fullblog_blobs WHERE hash=%s", (body_hash,))
+    if not cursor.fetchone():
+        cursor.execute("INSERT INTO fullblog_blobs (hash, body) "
+                "VALUES (%s, %s)", (body_hash, body))
+    cursor.execute("UPDATE fullblog_posts SET body='', body_hash=%s "
+            "WHERE name=%s AND version=%s", (body_hash, name, version))
+
+def _internalize_body(cursor, name, version):
+    """ Restores the body of a post version from the blob table into
+    the post row. Blobs are left for compact_post_storage() to clean. """
+    cursor.execute("SELECT b.body FROM fullblog_posts p, fullblog_blobs b "
+            "WHERE p.name=%s AND p.version=%s AND p.body='' "
+            "AND b.hash=p.body_hash", (name, version))
+    row = cursor.fetchone()
+    if row:
+        cursor.execute("UPDATE fullblog_posts SET body=%s "
+                "WHERE name=%s AND version=%s", (row[0], name, version))
+
+def _set_tags(cursor, name, categories):
+    """ Replaces the tags of a post with those in the categories string
+    (None if the post no longer exists). """
+    cursor.execute("DELETE FROM fullblog_tags WHERE name=%s", (name,))
+    tags = set(_parse_categories(categories or ''))
+    if tags:
+        cursor.executemany("INSERT INTO fullblog_tags (name, tag) "
+                "VALUES (%s, %s)", [(name, tag) for tag in tags])
+
+def _fill_tags(cursor, batch_size=1000):
+    """ Inserts the tags of all current post versions. """
+    cursor.execute("SELECT bp1.name, bp1.categories FROM fullblog_posts bp1, "
+            "(SELECT name, max(version) AS ver FROM fullblog_posts "
+            "GROUP BY name) bp2 "
+            "WHERE bp1.name = bp2.name AND bp1.version = bp2.ver")
+    rows = []
+    for name, categories in cursor.fetchall():
+        rows.extend([(name, tag) for tag in
+                     set(_parse_categories(categories or ''))])
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany("INSERT INTO fullblog_tags (name, tag) "
+                "VALUES (%s, %s)", rows[start:start + batch_size])
+
+def _update_post_stats(cursor, name):
+    """ Recounts the comments and attachments of a post into its stats
+    row. Called for every change to them, so reads are a single row. """
+    cursor.execute("SELECT COUNT(*), MAX(time) FROM fullblog_comments "
+            "WHERE name=%s", (name,))
+    comment_count, last_comment_time = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*) FROM attachment "
+            "WHERE type='blog' AND id=%s", (name,))
+    attachment_count = cursor.fetchone()[0]
+    cursor.execute("DELETE FROM fullblog_post_stats WHERE name=%s", (name,))
+    cursor.execute("INSERT INTO fullblog_post_stats (name, comment_count, "
+            "last_comment_time, attachment_count) VALUES (%s, %s, %s, %s)",
+            (name, comment_count, last_comment_time, attachment_count))
+
+def _fill_post_stats(cursor, batch_size=1000):
+    """ Inserts stats rows for all posts. """
+    cursor.execute("SELECT DISTINCT name FROM fullblog_posts")
+    stats = dict([(row[0], [row[0], 0, None, 0]) for row in cursor.fetchall()])
+    cursor.execute("SELECT name, COUNT(*), MAX(time) FROM fullblog_comments "
+            "GROUP BY name")
+    for name, comment_count, last_comment_time in cursor.fetchall():
+        if name in stats:
+            stats[name][1:3] = [comment_count, last_comment_time]
+    cursor.execute("SELECT id, COUNT(*) FROM attachment WHERE type='blog' "
+            "GROUP BY id")
+    for name, attachment_count in cursor.fetchall():
+        if name in stats:
+            stats[name][3] = attachment_count
+    rows = stats.values()
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany("INSERT INTO fullblog_post_stats (name, "
+                "comment_count, last_comment_time, attachment_count) "
+                "VALUES (%s, %s, %s, %s)", rows[start:start + batch_size])
+
+def _bump_generation(env, cursor, posts=True):
+    """ Sets a new generation marker, to be committed with the change.
+    The posts marker is changed too unless 'posts' is False (for changes to
+    comments only). """
+    generation = '%.6f.%d' % (time.time(), os.getpid())
+    cursor.execute("UPDATE system SET value=%s "
+            "WHERE name='fullblog_generation'", (generation,))
+    if posts:
+        cursor.execute("SELECT value FROM system "
+                "WHERE name='fullblog_posts_generation'")
+        row = cursor.fetchone()
+        cursor.execute("UPDATE system SET value=%s "
+                "WHERE name='fullblog_posts_generation'", (generation,))
+        _generations[env.path] = ((generation, generation), time.time())
+        _bumped[env.path] = (row and row[0] or '', generation)
+    else:
+        generations, checked = _generations.get(env.path, (None, 0))
+        if generations is None:
+            return # Both are read on next use
+        _generations[env.path] = ((generation, generations[1]), checked)
+
+def _last_bump(env):
+    """ Returns the posts generation (previous, new) of the last change
+    made by this process, or (None, None). """
+    return _bumped.get(env.path, (None, None))
+
+def _remove_unused_blobs(cursor):
+    """ Deletes stored bodies no longer used by any post version.
+    Returns the number of bodies removed. """
+    cursor.execute("SELECT count(*) FROM fullblog_blobs")
+    num_blobs = cursor.fetchone()[0]
+    # Versions from before body hashes were added have none - a NULL in
+    # the list would make NOT IN false for every blob
+    cursor.execute("DELETE FROM fullblog_blobs WHERE hash NOT IN "
+            "(SELECT body_hash FROM fullblog_posts WHERE body='' "
+            "AND body_hash IS NOT NULL)")
+    cursor.execute("SELECT count(*) FROM fullblog_blobs")
+    return num_blobs - cursor.fetchone()[0]
+
+def _fetch_body(cursor, body_hash):
+    """ Returns a stored body by hash, or empty string if not found. """
+    cursor.execute("SELECT body FROM fullblog_blobs WHERE hash=%s",
+            (body_hash,))
+    row = cursor.fetchone()
+    return row and row[0] or u''
+
 def _parse_categories(categories, sep=' '):
     """ Parses the string containing categories separated by sep.
     Internal method, used in case we want to change split strategy later. """
@@ -335,6 +628,108 @@ def _parse_categories(categories, sep=' '):
 
 # Classes
 
+class _Row(object):
+    """ Base for compact rows built from query results. The fields are
+    slots, and a row also works as the tuple returned by earlier versions:
+    it can be indexed, unpacked, compared with tuples and pickled. """
+
+    __slots__ = ()
+    # Slots in the order of the constructor arguments
+    _columns = ()
+    # Fields in the order of the tuple form
+    _fields = ()
+
+    def as_tuple(self):
+        return tuple([getattr(self, field) for field in self._fields])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.as_tuple()[key]
+        return getattr(self, self._fields[key])
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, _Row)):
+            return self.as_tuple() == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.as_tuple())
+
+    def __reduce__(self):
+        return (self.__class__,
+                tuple([getattr(self, column) for column in self._columns]))
+
+    def __repr__(self):
+        return '%s%r' % (self.__class__.__name__, self.as_tuple())
+
+
+class PostSummary(_Row):
+    """ A post version as listed by get_blog_posts(). 'time' is the
+    publish time, and 'categories' a list. """
+
+    __slots__ = ('name', 'version', 'time', 'author', 'title', 'body',
+                 'categories')
+    _columns = _fields = __slots__
+
+    def __init__(self, name, version, time, author, title, body,
+                 categories):
+        self.name = name
+        self.version = version
+        self.time = time
+        self.author = author
+        self.title = title
+        self.body = body
+        self.categories = categories
+
+    def from_row(cls, row):
+        """ Builds the post from (name, version, publish_time, author,
+        title, body, categories) column values. """
+        return cls(row[0], row[1], to_datetime(row[2], utc), row[3],
+                   row[4], row[5], _parse_categories(row[6] or u''))
+    from_row = classmethod(from_row)
+
+
+class PostMatch(PostSummary):
+    """ A post found by search_blog_posts(). Its tuple form leaves out the
+    categories. """
+
+    __slots__ = ()
+    _fields = PostSummary._fields[:6]
+
+
+class CommentRow(_Row):
+    """ A comment as listed by get_blog_comments(). Instantiate
+    BlogComment to change it. """
+
+    __slots__ = ('post_name', 'number', 'comment', 'author', 'time')
+    _columns = _fields = __slots__
+
+    def __init__(self, post_name, number, comment, author, time):
+        self.post_name = post_name
+        self.number = number
+        self.comment = comment
+        self.author = author
+        self.time = time
+
+    def from_row(cls, row):
+        """ Builds the comment from (name, number, comment, author, time)
+        column values. """
+        return cls(row[0], row[1], row[2], row[3], to_datetime(row[4], utc))
+    from_row = classmethod(from_row)
+
+
 class BlogComment(object):
     """ Model class representing a comment on a given post.
     Various methods supporting CRUD management of the comment. """
@@ -392,6 +787,8 @@ class BlogComment(object):
         cursor.execute("INSERT INTO fullblog_comments "
                 "VALUES (%s, %s, %s, %s, %s)", (self.post_name,
                 number, comment, author, to_timestamp(self.time)) )
+        _update_post_stats(cursor, self.post_name)
+        _bump_generation(self.env, cursor, posts=False)
         cnx.commit()
         self._load_comment(number)
         return warnings
@@ -406,6 +803,8 @@ class BlogComment(object):
         cursor.execute("DELETE FROM fullblog_comments "
                 "WHERE name=%s AND number=%s",  (
                 self.post_name, self.number))
+        _update_post_stats(cursor, self.post_name)
+        _bump_generation(self.env, cursor, posts=False)
         cnx.commit()
         return True
 
@@ -461,19 +860,23 @@ class BlogPost(object):
                     'version_author': u'',  # required
                     'author': u'',          # required
                     'categories': u''}
-    # Other data - fetched or computed
-    category_list = []
-    versions = []
-    
+    __slots__ = ('env', 'resource', 'name', 'version', 'title', 'body',
+                 'publish_time', 'version_time', 'version_comment',
+                 'version_author', 'author', 'categories',
+                 # Other data - fetched or computed
+                 'category_list', 'versions', 'excerpt')
+
     def __init__(self, env, name, version=0):
         self.env = env
-        # Expand the default values as object properties
-        for prop in self._db_default_fields.keys():
-            if isinstance(self._db_default_fields[prop], datetime.datetime):
-                # Default will evaluate to initial loading of the class itself
-                setattr(self, prop, datetime.datetime.now(utc))
-            else:
-                setattr(self, prop, self._db_default_fields[prop])
+        # Default values of the fields
+        now = datetime.datetime.now(utc)
+        self.version = 0
+        self.title = self.body = self.categories = u''
+        self.version_comment = self.version_author = self.author = u''
+        self.publish_time = self.version_time = now
+        self.category_list = []
+        self.versions = []
+        self.excerpt = u''
         self.name = name and name.strip() or name
         self._load_post(version)
         
@@ -481,6 +884,8 @@ class BlogPost(object):
         """ Saves the post as a new version in the database.
         Returns [] if saved without warnings, or a list of warnings
         if any errors occured.
+        The excerpt for listings is stored with the version, as wiki text
+        that is rendered for each reader.
         As this does not check for changes, the common usage is:
             if the_post.update_fields(fields_dict):
                 the_post.save('the_user', 'My view on things.')
@@ -502,15 +907,25 @@ class BlogPost(object):
             version = self.versions[-1] + 1
         self.env.log.debug("Saving new version %d of blog post %r "
                 "from author %r" % (version, self.name, version_author))
+        excerpt = make_excerpt(self.body,
+                self.env.config.getint('fullblog', 'excerpt_size'))
         cnx = self.env.get_db_cnx()
         cursor = cnx.cursor()
         cursor.execute("INSERT INTO fullblog_posts "
                 "(name, version, title, body, publish_time, version_time, "
-                "version_comment, version_author, author, categories) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                "version_comment, version_author, author, categories, "
+                "body_hash, excerpt) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
                 (self.name, version, self.title, self.body,
                 to_timestamp(self.publish_time), version_time,
-                version_comment, version_author, self.author, self.categories))
+                version_comment, version_author, self.author, self.categories,
+                _body_hash(self.body), excerpt))
+        if self.versions and self.env.config.get(
+                    'fullblog', 'version_storage') == 'dedup':
+            # Previous version is no longer current - store body by hash
+            _externalize_body(cursor, self.name, self.versions[-1])
+        _set_tags(cursor, self.name, self.categories)
+        _bump_generation(self.env, cursor)
         cnx.commit()
         self._load_post(version)
         return warnings
@@ -522,7 +937,7 @@ class BlogPost(object):
         True if one or more fields where updated. """
         changes_made = False
         for field in fields.keys():
-            if not hasattr(self, field):
+            if not field in self._db_default_fields:
                 continue    # skip non-existing attributes
             if field in ['name', 'version']:
                 continue    # skip the database keys
@@ -544,9 +959,22 @@ class BlogPost(object):
             cursor.execute("DELETE FROM fullblog_posts "
                     "WHERE name=%s AND version=%s",
                     (self.name, version))
+            # Make sure the new current version has its body inline
+            cursor.execute("SELECT max(version) FROM fullblog_posts "
+                    "WHERE name=%s", (self.name,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                _internalize_body(cursor, self.name, row[0])
+            cursor.execute("SELECT categories FROM fullblog_posts "
+                    "WHERE name=%s ORDER BY version DESC LIMIT 1",
+                    (self.name,))
+            row = cursor.fetchone()
+            _set_tags(cursor, self.name, row and row[0])
         else:
             cursor.execute("DELETE FROM fullblog_posts "
                     "WHERE name=%s", (self.name,))
+            _set_tags(cursor, self.name, None)
+        _bump_generation(self.env, cursor)
         cnx.commit()
         if not len(self.get_versions()):
             # Delete comments
@@ -554,6 +982,10 @@ class BlogPost(object):
                 comment.delete()
             # Delete attachments
             Attachment.delete_all(self.env, 'blog', self.name, cnx)
+            cursor.execute("DELETE FROM fullblog_post_stats "
+                    "WHERE name=%s", (self.name,))
+            cursor.execute("DELETE FROM fullblog_views "
+                    "WHERE name=%s", (self.name,))
             cnx.commit()
         return True
     
@@ -567,23 +999,60 @@ class BlogPost(object):
         self.versions = sorted([row[0] for row in cursor])
         return self.versions
         
-    def get_comments(self):
-        """ Returns a list of used comment numbers attached to the post.
-        It instantiates BlogComment objects for comments attached to the
-        current BlogPost, and returns them in a list sorted by number. """
-        comments = sorted(get_blog_comments(self.env, post_name=self.name),
-                    key=itemgetter(1))
-        return [BlogComment(self.env, comment[0],
-                        comment[1]) for comment in comments]
-        
-    def get_attachment_num(self):
-        attachment = []
+    def get_comments(self, after=0, limit=0):
+        """ Returns BlogComment objects for the comments attached to the
+        current BlogPost, sorted by number. Use 'after' to only get comments
+        numbered higher than that, and 'limit' for the most to return.
+        All comments are read in one ordered query. """
         cnx = self.env.get_db_cnx()
         cursor = cnx.cursor()
-        cursor.execute("SELECT * from attachment WHERE type = 'blog' AND id = %s", (self.name,))
-        for row in cursor:
-            attachment.append(row)
-        return len(attachment)
+        sql = "SELECT number, comment, author, time FROM fullblog_comments " \
+              "WHERE name=%s AND number>%s ORDER BY number"
+        if limit:
+            sql += " LIMIT %d" % int(limit)
+        cursor.execute(sql, (self.name, after))
+        comments = []
+        for number, comment, author, time in cursor:
+            bc = BlogComment(self.env, self.name)
+            bc.number = number
+            bc.comment = comment
+            bc.author = author
+            bc.time = to_datetime(time, utc)
+            comments.append(bc)
+        return comments
+
+    def get_stats(self):
+        """ Returns (comment_count, last_comment_time, attachment_count) for
+        the post. Last comment time is None if there are no comments. """
+        cnx = self.env.get_db_cnx()
+        cursor = cnx.cursor()
+        cursor.execute("SELECT comment_count, last_comment_time, "
+                "attachment_count FROM fullblog_post_stats "
+                "WHERE name=%s", (self.name,))
+        row = cursor.fetchone()
+        if not row:
+            return 0, None, 0
+        return (row[0], row[1] and to_datetime(row[1], utc) or None, row[2])
+
+    def get_comment_count(self):
+        """ Returns the number of comments attached to the post. """
+        return self.get_stats()[0]
+
+    def get_excerpt(self, max_size=0):
+        """ Returns (text, truncated) for showing the post in listings.
+        The stored excerpt is used if it is no larger than max_size (when
+        given). The text is wiki text, to be rendered in the context of the
+        reader. Truncated is True if the text is not the full body. """
+        text = self.excerpt
+        if not text or (max_size and len(text) > max_size):
+            # Not stored for versions saved before excerpts, or too large
+            text = make_excerpt(self.body, max_size or
+                    self.env.config.getint('fullblog', 'excerpt_size'))
+        return text, text != self.body
+
+    def get_attachment_num(self):
+        """ Returns the number of attachments of the post. """
+        return self.get_stats()[2]
 
     
     # Internal methods
@@ -593,40 +1062,64 @@ class BlogPost(object):
         of a specific version of a blog post, or last/current version if
         version is 0.
         Returns emtpy dict if no such post or post/version exists. """
+        version, row = self._fetch_row(version)
+        if row is None:
+            return {}
+        return {'version': version,
+                'title': row[0],
+                'body': row[1],
+                'publish_time': to_datetime(row[2], utc),
+                'version_time': to_datetime(row[3], utc),
+                'version_comment': row[4],
+                'version_author': row[5],
+                'author': row[6],
+                'categories': row[7],
+                'category_list': set(_parse_categories(row[7])),
+                'excerpt': row[9] or u''}
+
+    def _fetch_row(self, version=0):
+        """ Returns (version, row) with the columns of a specific version of
+        the post, or of the last/current version if version is 0.
+        Returns (0, None) if no such post or post/version exists. """
         self.versions = self.get_versions()
         if not self.versions or (version and not version in self.versions):
             # No blog post with the name exists
-            return {}
+            return 0, None
         version = version or self.versions[-1]
         cnx = self.env.get_db_cnx()
         cursor = cnx.cursor()
         cursor.execute("SELECT title, body, publish_time, version_time, "
-                "version_comment, version_author, author, categories "
+                "version_comment, version_author, author, categories, "
+                "body_hash, excerpt "
                 "FROM fullblog_posts "
                 "WHERE name=%s AND version=%s",
                 (self.name, version) )
-        fields = {}
-        for row in cursor:
-            fields['version'] = version
-            fields['title'] = row[0]
-            fields['body'] = row[1]
-            fields['publish_time'] = to_datetime(row[2], utc)
-            fields['version_time'] = to_datetime(row[3], utc)
-            fields['version_comment'] = row[4]
-            fields['version_author'] = row[5]
-            fields['author'] = row[6]
-            fields['categories'] = row[7]
-            fields['category_list'] = set(_parse_categories(row[7]))
-        return fields
+        row = cursor.fetchone()
+        if row is None:
+            return 0, None
+        if not row[1] and row[8]:
+            # Old version with body stored by content hash
+            row = list(row)
+            row[1] = _fetch_body(cursor, row[8])
+        return version, row
 
     def _load_post(self, version=0):
         """ Loads the record from the database into the object.
         Will load the most recent if none is specified.
         Also creates a Resource instance for the object."""
         self.resource = Resource('blog', self.name)
-        fields = self._fetch_fields(version)
-        if not fields:
+        version, row = self._fetch_row(version)
+        if row is None:
             return False
-        for field in fields:
-            setattr(self, field, fields[field])
+        self.version = version
+        self.title = row[0]
+        self.body = row[1]
+        self.publish_time = to_datetime(row[2], utc)
+        self.version_time = to_datetime(row[3], utc)
+        self.version_comment = row[4]
+        self.version_author = row[5]
+        self.author = row[6]
+        self.categories = row[7]
+        self.category_list = set(_parse_categories(row[7]))
+        self.excerpt = row[9] or u''
         return True
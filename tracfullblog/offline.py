@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of blog pages outside of a web request, by running anonymous
+requests through the Trac WSGI application in the current process.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import sys
+import urlparse
+from StringIO import StringIO
+
+from trac.util.text import to_utf8
+from trac.web.main import dispatch_request
+
+__all__ = ['fetch_page']
+
+
+def fetch_page(env, path, query='', headers=None):
+    """ Makes an anonymous GET request for path (like '/blog') and returns
+    a (status_code, headers, body) tuple. Headers is a list of
+    (name, value) tuples; request headers can be passed the same way.
+    Unicode paths are sent as UTF-8.
+    The host and script name are taken from '[trac] base_url' if set. """
+    base_url = env.config.get('trac', 'base_url') or 'http://localhost/'
+    scheme, netloc, script_name = urlparse.urlsplit(base_url)[:3]
+    host, port = (netloc.split(':', 1) + [''])[:2]
+    environ = {'REQUEST_METHOD': 'GET',
+               'SCRIPT_NAME': script_name.rstrip('/'),
+               'PATH_INFO': to_utf8(path),
+               'QUERY_STRING': query,
+               'SERVER_NAME': host or 'localhost',
+               'SERVER_PORT': port or (scheme == 'https' and '443' or '80'),
+               'HTTP_HOST': netloc or 'localhost',
+               'SERVER_PROTOCOL': 'HTTP/1.0',
+               'REMOTE_ADDR': '127.0.0.1',
+               'wsgi.url_scheme': scheme or 'http',
+               'wsgi.input': StringIO(''),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': True,
+               'wsgi.run_once': False,
+               'trac.env_path': env.path}
+    for name, value in headers or []:
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    response = {}
+    chunks = []
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = response_headers
+        return chunks.append # Trac writes most output using this callable
+    result = dispatch_request(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], ''.join(chunks)
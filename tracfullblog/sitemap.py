@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Sitemaps (http://www.sitemaps.org/) for the blog posts.
+
+/blog/sitemap.xml lists all posts, or for blogs with more posts than fit in
+one sitemap it is a sitemap index pointing to /blog/sitemap-N.xml chunks.
+Rows are streamed from an ordered cursor straight to the response, and each
+document is served with validators so crawlers can skip unchanged chunks.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+import re
+from hashlib import sha1
+from xml.sax.saxutils import escape
+
+from trac.resource import Resource
+from trac.util.datefmt import http_date, to_datetime, utc
+from trac.util.text import to_utf8
+from trac.web.api import HTTPNotFound, RequestDone
+
+__all__ = ['match_sitemap', 'send_sitemap']
+
+# Most URLs allowed in one sitemap file
+chunk_size = 50000
+
+# Rows written to the response at a time
+write_rows = 500
+
+_sitemap_re = re.compile(r'^sitemap(?:-(\d+))?\.xml$')
+
+
+def match_sitemap(blog_path):
+    """ Returns the chunk number for a sitemap path ('sitemap-N.xml'), 0 for
+    'sitemap.xml', or None if the path is not a sitemap. """
+    match = _sitemap_re.match(blog_path)
+    if match:
+        return int(match.group(1) or 0)
+
+def send_sitemap(env, req, chunk=0):
+    """ Sends the sitemap (or sitemap index) for chunk 0, or the numbered
+    chunk. Raises RequestDone. """
+    cursor = env.get_db_cnx().cursor()
+    cursor.execute("SELECT COUNT(DISTINCT name), MAX(version_time) "
+                   "FROM fullblog_posts")
+    total, last_time = cursor.fetchone()
+    chunks = (total - 1) // chunk_size + 1
+    if chunk == 0 and chunks <= 1:
+        _send_urlset(env, req, 0)
+    elif chunk == 0:
+        modified = to_datetime(last_time or 0, utc)
+        req.check_modified(modified, 'sitemapindex-%d' % chunks)
+        _start(req, modified)
+        req.write('<sitemapindex '
+                  'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for number in range(1, chunks + 1):
+            req.write('<sitemap><loc>%s</loc></sitemap>\n' % escape(
+                      to_utf8(req.abs_href.blog('sitemap-%d.xml' % number))))
+        req.write('</sitemapindex>\n')
+    elif chunk <= chunks:
+        _send_urlset(env, req, (chunk - 1) * chunk_size)
+    else:
+        raise HTTPNotFound("No sitemap number %d." % chunk)
+    raise RequestDone
+
+# Internal functions
+
+def _send_urlset(env, req, offset):
+    cursor = env.get_db_cnx().cursor()
+    # Validators from the rows of the chunk: the newest change, and the
+    # first, last and number of names (changed if posts are added or deleted)
+    cursor.execute("SELECT COUNT(*), MIN(name), MAX(name), MAX(changed) "
+                   "FROM (SELECT name, MAX(version_time) AS changed "
+                   "FROM fullblog_posts GROUP BY name ORDER BY name "
+                   "LIMIT %s OFFSET %s) AS chunk", (chunk_size, offset))
+    count, first, last, last_time = cursor.fetchone()
+    modified = to_datetime(last_time or 0, utc)
+    req.check_modified(modified, sha1(
+            to_utf8(u'%s:%s:%s' % (count, first, last))).hexdigest())
+    _start(req, modified)
+    req.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    cursor.execute("SELECT name, MAX(version_time) FROM fullblog_posts "
+                   "GROUP BY name ORDER BY name LIMIT %s OFFSET %s",
+                   (chunk_size, offset))
+    rows = []
+    for name, changed in cursor:
+        if not 'BLOG_VIEW' in req.perm(Resource('blog', name)):
+            continue
+        rows.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+                escape(to_utf8(req.abs_href.blog(name))),
+                datetime.datetime.utcfromtimestamp(changed).strftime(
+                                                    '%Y-%m-%dT%H:%M:%SZ')))
+        if len(rows) == write_rows:
+            req.write(''.join(rows))
+            rows = []
+    req.write(''.join(rows) + '</urlset>\n')
+
+def _start(req, modified):
+    req.send_response(200)
+    req.send_header('Content-Type', 'application/xml; charset=utf-8')
+    req.send_header('Last-Modified', http_date(modified))
+    req.end_headers()
+    req.write('<?xml version="1.0" encoding="UTF-8"?>\n')
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Export of the blog as static files, for serving directly from a front-end
+web server.
+
+Pages are rendered as an anonymous user (see offline.py), and written to
+files named after the request:
+    /blog                   -> index.html
+    /blog?page=N            -> index-N.html
+    /blog?format=rss        -> rss.xml
+    /blog/<path>            -> <path>/index.html
+    /blog/<path>?format=rss -> <path>/rss.xml
+Links inside the pages are not changed; map the query string variants with
+rewrite rules in the front-end server.
+
+Changes to posts and comments record the affected paths, so an incremental
+export only renders those pages (plus the front pages, archive and main feed
+when posts have changed). The sidebar of pages that are not re-rendered may
+show outdated counts until the next full export. Bulk changes (imports and
+pruning of versions) are not recorded per page, and make the next export a
+full one instead.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import os
+import time
+
+from trac.core import *
+from trac.util.datefmt import to_datetime, utc
+
+from api import IBlogChangeListener
+from index import get_post_index
+from model import _parse_categories
+from offline import fetch_page
+
+__all__ = ['export_static', 'reset_static_export', 'FullBlogStaticTracker']
+
+# Path recorded for changes affecting the front pages, archive and main feed
+front_path = '/blog'
+
+
+def export_static(env, directory, incremental=False):
+    """ Renders blog pages to files in directory. With incremental, only
+    pages affected by changes since the last export are rendered (a full
+    export is made if there has been none). Pages are rendered and written
+    one at a time. Returns (written, removed) counts of files. """
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    started = int(time.time())
+    cursor.execute("SELECT value FROM system "
+                   "WHERE name='fullblog_static_export'")
+    exported = cursor.fetchone()
+    if incremental and exported:
+        cursor.execute("SELECT path FROM fullblog_static_changes")
+        pages = _touched_pages(env, [row[0] for row in cursor.fetchall()])
+    else:
+        pages = _all_pages(env)
+    written = removed = 0
+    for path, query in pages:
+        filename = _filename(directory, path, query)
+        status, headers, body = fetch_page(env, path, query)
+        if status == 200:
+            _write_file(filename, body)
+            written += 1
+        elif status == 404 and os.path.exists(filename):
+            os.remove(filename)
+            removed += 1
+        else:
+            env.log.warning("FullBlog: Static export of %s?%s returned %d" % (
+                        path, query, status))
+    # Changes made during the export are kept for the next one
+    cursor.execute("DELETE FROM fullblog_static_changes WHERE time < %s",
+                   (started,))
+    if exported:
+        cursor.execute("UPDATE system SET value=%s "
+                       "WHERE name='fullblog_static_export'", (str(started),))
+    else:
+        cursor.execute("INSERT INTO system VALUES "
+                       "('fullblog_static_export', %s)", (str(started),))
+    db.commit()
+    return written, removed
+
+def reset_static_export(env):
+    """ Makes the next incremental export a full one, after changes that
+    are not recorded per page. """
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    cursor.execute("DELETE FROM system WHERE name='fullblog_static_export'")
+    cursor.execute("DELETE FROM fullblog_static_changes")
+    db.commit()
+
+
+class FullBlogStaticTracker(Component):
+    """ Records the paths affected by blog changes, for incremental static
+    exports. Nothing is recorded until the first export has been made. """
+
+    implements(IBlogChangeListener)
+
+    # IBlogChangeListener methods
+
+    def blog_post_changed(self, postname, version):
+        self._record(self._post_paths(postname))
+
+    def blog_post_deleted(self, postname, version, fields):
+        paths = self._post_paths(postname)
+        if fields:
+            paths.update(_listing_paths(fields.get('publish_time'),
+                    fields.get('author'), fields.get('categories')))
+        self._record(paths)
+
+    def blog_comment_added(self, postname, number):
+        self._record(set(['/blog/' + postname]))
+
+    def blog_comment_deleted(self, postname, number, fields):
+        self._record(set(['/blog/' + postname]))
+
+    # Internal methods
+
+    def _post_paths(self, postname):
+        """ Paths showing the post in any of its versions, so that listings
+        it was moved out of are updated too. """
+        paths = set([front_path, '/blog/' + postname])
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT publish_time, author, categories "
+                       "FROM fullblog_posts WHERE name=%s", (postname,))
+        for publish_time, author, categories in cursor.fetchall():
+            paths.update(_listing_paths(publish_time, author, categories))
+        return paths
+
+    def _record(self, paths):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system "
+                       "WHERE name='fullblog_static_export'")
+        if not cursor.fetchone():
+            return
+        now = int(time.time())
+        cursor.executemany("DELETE FROM fullblog_static_changes "
+                           "WHERE path=%s", [(path,) for path in paths])
+        cursor.executemany("INSERT INTO fullblog_static_changes "
+                           "(path, time) VALUES (%s, %s)",
+                           [(path, now) for path in paths])
+        db.commit()
+
+# Internal functions
+
+def _listing_paths(publish_time, author, categories):
+    """ Month, author and category listing paths of a post version. """
+    paths = set()
+    if publish_time:
+        if not hasattr(publish_time, 'year'):
+            publish_time = to_datetime(publish_time, utc)
+        paths.add('/blog/%d/%d' % (publish_time.year, publish_time.month))
+    if author:
+        paths.add('/blog/author/' + author)
+    if isinstance(categories, basestring):
+        categories = _parse_categories(categories)
+    for category in categories or []:
+        paths.add('/blog/category/' + category)
+    return paths
+
+def _front_pages(env, index):
+    from web_ui import FullBlogModule
+    per_page = FullBlogModule(env).num_items or 1
+    yield front_path, ''
+    for page in range(2, (index.count() - 1) // per_page + 2):
+        yield front_path, 'page=%d' % page
+    yield front_path, 'format=rss'
+    yield '/blog/archive', ''
+
+def _listing_pages(path):
+    yield path, ''
+    if path.startswith('/blog/author/') or path.startswith('/blog/category/'):
+        yield path, 'format=rss'
+
+def _all_pages(env):
+    """ Yields (path, query) of all pages of the blog. """
+    index = get_post_index(env)
+    for page in _front_pages(env, index):
+        yield page
+    months, authors, categories, total = index.aggregate(index.select())
+    for (year, month), count in months:
+        yield '/blog/%d/%d' % (year, month), ''
+    for author, count in authors:
+        for page in _listing_pages('/blog/author/' + author):
+            yield page
+    for category, count in categories:
+        for page in _listing_pages('/blog/category/' + category):
+            yield page
+    for position in index.select():
+        yield '/blog/' + index.names[position], ''
+
+def _touched_pages(env, paths):
+    """ Yields (path, query) of the pages affected by recorded paths. """
+    paths = set(paths)
+    if front_path in paths:
+        paths.remove(front_path)
+        for page in _front_pages(env, get_post_index(env)):
+            yield page
+    for path in sorted(paths):
+        for page in _listing_pages(path):
+            yield page
+
+def _filename(directory, path, query):
+    """ Returns the file name for a page (see module documentation). """
+    parts = [part for part in path.split('/')[2:]
+             if part and part not in ('.', '..')]
+    if query == 'format=rss':
+        parts.append('rss.xml')
+    elif query.startswith('page='):
+        parts.append('index-%s.html' % query[5:])
+    else:
+        parts.append('index.html')
+    return os.path.join(directory, *[part.encode('utf-8')
+                                     for part in parts])
+
+def _write_file(filename, body):
+    """ Writes to a temporary file that is renamed, so that the web server
+    never serves a partial page. """
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+    fp = open(tmp_name, 'wb')
+    try:
+        fp.write(body)
+    finally:
+        fp.close()
+    os.rename(tmp_name, filename)
@@ -13,7 +13,8 @@ from trac.util.compat import set
 from trac.resource import Resource, get_resource_description
 from trac.web.chrome import Chrome
 
-from model import BlogPost, _parse_categories
+from core import FullBlogCore
+from model import BlogPost
 
 
 class FullBlogTagSystem(Component):
@@ -30,36 +31,36 @@ class FullBlogTagSystem(Component):
         db = self.env.get_db_cnx()
         cursor = db.cursor()
 
-        args = []
-        constraints = []
-        sql = "SELECT bp1.name, bp1.categories, bp1.version " \
-               "FROM fullblog_posts bp1," \
-               "(SELECT name, max(version) AS ver " \
-               "FROM fullblog_posts GROUP BY name) bp2 " \
-               "WHERE bp1.version = bp2.ver AND bp1.name = bp2.name"
+        sql = "SELECT name, tag FROM fullblog_tags"
         if tags:
-            constraints.append("(" + ' OR '.join(
-                            ["bp1.categories LIKE %s" for t in tags]) + ")")
-            args += ['%' + t + '%' for t in tags]
-        else:
-            constraints.append("bp1.categories != ''")
-        if constraints:
-            sql += " AND " + " AND ".join(constraints)
-        sql += " ORDER BY bp1.name"
+            tags = list(tags)
+            sql += " WHERE name IN (SELECT name FROM fullblog_tags " \
+                   "WHERE tag IN (%s))" % ', '.join(['%s'] * len(tags))
+        sql += " ORDER BY name"
         self.env.log.debug(sql)
-        cursor.execute(sql, args)
-        for row in cursor:
-            post_name, categories = row[0], set(_parse_categories(row[1]))
-            if not tags or categories.intersection(tags):
-                resource = Resource('blog', post_name)
-                if 'BLOG_VIEW' in req.perm(resource) and \
-                        'TAGS_VIEW' in req.perm(resource):
-                    yield (resource, categories)
+        cursor.execute(sql, tags or None)
+        # Rows are grouped by post, so each post is checked once
+        post_name, categories = None, set()
+        for name, tag in cursor:
+            if name != post_name:
+                if post_name is not None:
+                    resource = Resource('blog', post_name)
+                    if self._can_view(req, resource):
+                        yield (resource, categories)
+                post_name, categories = name, set()
+            categories.add(tag)
+        if post_name is not None:
+            resource = Resource('blog', post_name)
+            if self._can_view(req, resource):
+                yield (resource, categories)
 
     def get_resource_tags(self, req, resource):
         req.perm(resource).require('BLOG_VIEW')
         req.perm(resource).require('TAGS_VIEW')
-        return BlogPost(self.env, resource.id).category_list
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT tag FROM fullblog_tags WHERE name=%s",
+                       (resource.id,))
+        return set([row[0] for row in cursor])
 
     def set_resource_tags(self, req, resource, tags):
         req.perm(resource).require('TAGS_MODIFY')
@@ -83,7 +84,15 @@ class FullBlogTagSystem(Component):
 
     def describe_tagged_resource(self, req, resource):
         # The plugin already uses the title as main description
-        post = BlogPost(self.env, resource.id)
+        info = FullBlogCore(self.env).get_post_info(resource.id)
+        if info is None:
+            return "'" + resource.id + "'"
         chrome = Chrome(self.env)
         return "'" + resource.id + "' by " \
-                                    + chrome.format_author(req, post.author)
+                                    + chrome.format_author(req, info[2])
+
+    # Internal methods
+
+    def _can_view(self, req, resource):
+        perm = req.perm(resource)
+        return 'BLOG_VIEW' in perm and 'TAGS_VIEW' in perm
@@ -9,10 +9,14 @@ License: BSD
 
 import datetime
 import calendar
+import re
 
 from trac.util.datefmt import utc
 from trac.util.text import to_unicode
 
+# Line marking the end of the excerpt of a post body
+_more_re = re.compile(r'^[ \t]*\[\[more(?:\(\))?\]\][ \t]*$', re.I | re.M)
+
 
 def add_months(thedate, months):
     """ Add <months> months to <thedate>. """
@@ -44,3 +48,25 @@ def parse_period(items=[]):
         # Not integers, ignore
         to_dt = from_dt = None
     return from_dt, to_dt
+
+def make_excerpt(body, size):
+    """ Returns the start of body for use in listings: the text before a
+    `[[more]]` line if there is one, else at most size characters ending at
+    a paragraph, line or word break. An unclosed `{{{` block is closed.
+    Returns body unchanged if it is short enough (or size is 0). """
+    match = _more_re.search(body)
+    if match:
+        excerpt = body[:match.start()].rstrip()
+    elif not size or len(body) <= size:
+        return body
+    else:
+        excerpt = body[:size]
+        for separator in ('\n\n', '\n', ' '):
+            cut = excerpt.rfind(separator)
+            if cut > size // 2:
+                excerpt = excerpt[:cut]
+                break
+        excerpt = excerpt.rstrip() + u' ...'
+    if excerpt.count('{{{') > excerpt.count('}}}'):
+        excerpt += u'\n}}}'
+    return excerpt
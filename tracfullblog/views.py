@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Counting of post views, and the most viewed posts.
+
+Views are counted in memory by each process. The counts are added to the
+fullblog_views table in batches: by a background thread every
+`view_flush_interval` seconds, or by the request that brings the number of
+views waiting in the process up to `view_flush_threshold`. Views counted by
+a process since its last flush are lost if it stops.
+
+The counts are read back in one query and kept in each process for
+`view_flush_interval` seconds, ranked, so the most viewed posts are a slice.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import threading
+import time
+
+from trac.resource import Resource
+
+from index import get_post_index
+
+__all__ = ['count_view', 'flush_views', 'get_view_counts',
+           'get_popular_posts']
+
+# Views not yet written, per environment path: {name: views}
+_pending = {}
+_pending_lock = threading.Lock()
+
+# Background threads writing views, per environment path: (env, thread)
+_flushers = {}
+
+# Counts read from the table, per environment path: (time, counts, ranking)
+_counts = {}
+
+
+def count_view(env, name):
+    """ Counts a view of the post, if there is such a post. Failures to
+    write the counts are logged, and never raised to the request. """
+    if get_post_index(env).position(name) is None:
+        return
+    _pending_lock.acquire()
+    try:
+        views = _pending.setdefault(env.path, {})
+        views[name] = views.get(name, 0) + 1
+        waiting = sum(views.itervalues())
+    finally:
+        _pending_lock.release()
+    _start_flusher(env)
+    if waiting >= env.config.getint('fullblog', 'view_flush_threshold'):
+        try:
+            flush_views(env)
+        except Exception, e:
+            # The views stay pending, and are written by a later flush
+            env.log.error("FullBlog: Writing view counts failed: %s" % e)
+
+def flush_views(env):
+    """ Writes the views counted by this process to the database.
+    Returns the number of posts updated. """
+    _pending_lock.acquire()
+    try:
+        views = _pending.pop(env.path, None)
+    finally:
+        _pending_lock.release()
+    if not views:
+        return 0
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    try:
+        for name, count in sorted(views.items()):
+            cursor.execute("UPDATE fullblog_views SET views=views+%s "
+                           "WHERE name=%s", (count, name))
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO fullblog_views (name, views) "
+                               "VALUES (%s, %s)", (name, count))
+        db.commit()
+    except:
+        db.rollback()
+        _restore(env, views)
+        raise
+    return len(views)
+
+def get_view_counts(env):
+    """ Returns ({name: views}, [names by views, most viewed first]) as
+    written to the database, read at most once per `view_flush_interval`
+    seconds by each process. """
+    interval = env.config.getint('fullblog', 'view_flush_interval')
+    loaded = _counts.get(env.path)
+    if loaded and loaded[0] + interval > time.time():
+        return loaded[1:]
+    cursor = env.get_db_cnx().cursor()
+    cursor.execute("SELECT name, views FROM fullblog_views "
+                   "ORDER BY views DESC, name")
+    rows = cursor.fetchall()
+    counts = dict(rows)
+    ranking = [name for name, views in rows]
+    _counts[env.path] = (time.time(), counts, ranking)
+    return counts, ranking
+
+def get_popular_posts(env, perm=None, limit=5):
+    """ Returns a list of (name, title, views) for the most viewed posts,
+    most viewed first. Deleted posts are skipped, and if 'perm' is provided
+    posts the user cannot view. """
+    counts, ranking = get_view_counts(env)
+    index = get_post_index(env)
+    popular = []
+    for name in ranking:
+        if len(popular) == limit:
+            break
+        position = index.position(name)
+        if position is None:
+            continue
+        if perm and not 'BLOG_VIEW' in perm(Resource('blog', name)):
+            continue
+        popular.append((name, index.titles[position], counts[name]))
+    return popular
+
+# Internal functions
+
+def _restore(env, views):
+    """ Puts views that could not be written back with the pending views. """
+    _pending_lock.acquire()
+    try:
+        pending = _pending.setdefault(env.path, {})
+        for name, count in views.items():
+            pending[name] = pending.get(name, 0) + count
+    finally:
+        _pending_lock.release()
+
+def _start_flusher(env):
+    """ Starts the thread writing views of the environment, unless one is
+    already running for this environment object in this process. A thread
+    started for an earlier (reloaded) environment object with the same path
+    stops when the new one is registered. """
+    current, worker = _flushers.get(env.path, (None, None))
+    if current is env and worker.isAlive():
+        return
+    _pending_lock.acquire()
+    try:
+        current, worker = _flushers.get(env.path, (None, None))
+        if current is env and worker.isAlive():
+            return
+        worker = threading.Thread(target=_flush_loop, args=(env,),
+                                  name='FullBlog view counts')
+        worker.setDaemon(True)
+        _flushers[env.path] = (env, worker)
+        worker.start()
+    finally:
+        _pending_lock.release()
+
+def _flush_loop(env):
+    me = threading.currentThread()
+    while _flushers.get(env.path, (None, None))[1] is me:
+        time.sleep(max(1, env.config.getint('fullblog',
+                                            'view_flush_interval')))
+        if _flushers.get(env.path, (None, None))[1] is not me:
+            break # Replaced, views are written by the new thread
+        try:
+            flush_views(env)
+        except Exception, e:
+            env.log.error("FullBlog: Writing view counts failed: %s" % e)
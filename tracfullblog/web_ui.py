@@ -10,7 +10,12 @@ License: BSD
 
 # Imports from standard lib
 import datetime
+import gzip
 import re
+import time
+from cStringIO import StringIO
+from hashlib import sha1
+from itertools import takewhile
 from pkg_resources import resource_filename
 
 # Trac and Genshi imports
@@ -23,11 +28,11 @@ from trac.resource import Resource
 from trac.search.api import ISearchSource, shorten_result
 from trac.timeline.api import ITimelineEventProvider
 from trac.util import arity
-from trac.util.datefmt import utc
-from trac.util.text import shorten_line
+from trac.util.datefmt import to_datetime, utc
+from trac.util.text import shorten_line, to_utf8
 from trac.util.translation import _
-from trac.web.api import IRequestHandler, HTTPNotFound
-from trac.web.chrome import INavigationContributor, ITemplateProvider, \
+from trac.web.api import IRequestHandler, HTTPNotFound, RequestDone
+from trac.web.chrome import Chrome, INavigationContributor, ITemplateProvider, \
         add_stylesheet, add_link, add_warning, add_notice, add_ctxtnav, prevnext_nav
 from trac.wiki.formatter import format_to
 
@@ -41,7 +46,10 @@ except ImportError:
 # Imports from same package
 from model import *
 from core import FullBlogCore
-from util import map_month_names, parse_period
+from index import get_post_index
+from sitemap import match_sitemap, send_sitemap
+from util import parse_period
+from views import count_view, get_popular_posts
 
 __all__ = ['FullBlogModule']
 
@@ -69,6 +77,27 @@ class FullBlogModule(Component):
         """Option to specify how many recent posts to display on the
         front page of the Blog (and RSS feeds).""")
 
+    page_cache = BoolOption('fullblog', 'page_cache', False,
+        """Store the rendered output of blog pages and RSS feeds viewed
+        anonymously in the cache, together with a gzip-compressed copy.
+        The stored output is sent until the blog changes, compressed when
+        the client accepts it.""")
+
+    comments_per_page = IntOption('fullblog', 'comments_per_page', 50,
+        """Number of comments shown at a time on the page of a post, with
+        links to later comments (0 = show all).""")
+
+    popular_posts = IntOption('fullblog', 'popular_posts', 5,
+        """Number of most viewed posts listed in the sidebar, when views
+        are counted (see `count_views`).""")
+
+    related_posts = IntOption('fullblog', 'related_posts', 5,
+        """Number of related posts (sharing most categories) listed
+        below a post (0 = none).""")
+
+    # Most posts shown on category, author and month listings
+    max_listing = 100
+
     # INavigationContributor methods
     
     def get_active_navigation_item(self, req):
@@ -104,6 +133,28 @@ class FullBlogModule(Component):
 
         req.perm('blog').assert_permission('BLOG_VIEW')
 
+        sitemap_chunk = match_sitemap(req.args.get('blog_path', ''))
+        if sitemap_chunk is not None:
+            send_sitemap(self.env, req, sitemap_chunk)
+
+        if req.method == 'GET' and not req.args.get('format') \
+                and self.config.getbool('fullblog', 'count_views'):
+            command, pagename = self._parse_path(req)[:2]
+            # Same check as when rendering the post (also for stored pages),
+            # so views are only counted for users allowed to see it
+            if command == 'view' and pagename and \
+                    'BLOG_VIEW' in req.perm(Resource('blog', pagename)):
+                count_view(self.env, pagename)
+
+        if self.page_cache and req.method == 'GET' \
+                and req.authname == 'anonymous' \
+                and req.args.get('format', '').lower() in ('', 'rss'):
+            self._send_cached_page(req)
+        return self._render_request(req)
+
+    def _render_request(self, req):
+        """ Handles a request for the blog, returning the template, data
+        and content type. """
         blog_core = FullBlogCore(self.env)
         format = req.args.get('format', '').lower()
 
@@ -114,15 +165,20 @@ class FullBlogModule(Component):
         except:
             version = 0
 
+        if format == 'atom':
+            return self._render_atom(req, command, pagename, listing_data)
+
         data = {}
         template = 'fullblog_view.html'
-        data['blog_about'] = BlogPost(self.env, 'about')
-        data['blog_infotext'] = blog_core.get_bloginfotext()
-        blog_month_names = map_month_names(
-                    self.env.config.getlist('fullblog', 'month_names'))
+        settings = blog_core.get_settings()
+        data['blog_about'] = settings['about']
+        data['blog_infotext'] = settings['infotext']
+        blog_month_names = settings['month_names']
         data['blog_month_names'] = blog_month_names
 
-        user_recent_post = get_blog_posts(self.env,author=req.authname, per_num='3' ,current_num='0') 
+        index = get_post_index(self.env)
+        user_recent_post = index.summaries(
+                index.select(author=req.authname, order='version_time')[:3])
         if user_recent_post:   
             data['user_recent_post'] = user_recent_post
 
@@ -172,11 +228,9 @@ class FullBlogModule(Component):
                 
             data['blog_post_list'] = []
             count = 0
-            maxcount = self.num_items
-            if page:  
-                blog_posts = get_blog_posts(self.env,per_num=maxcount, current_num=(page-1))
-            else:
-                blog_posts = get_blog_posts(self.env,per_num=maxcount)
+            maxcount = settings['num_items']
+            blog_posts = index.summaries(index.select(order='version_time')[
+                                    (page-1)*maxcount:page*maxcount])
             if not blog_posts:
                 del data['page_next1'],data['page_next2'],data['page_next3'],data['page_next4'],data['page_next']
 #                data['page_next1'] = data['page_next2'] =  data['page_next3'] = data['page_next4'] = data['page_next'] = ''
@@ -195,6 +249,8 @@ class FullBlogModule(Component):
                     or '')
             add_link(req, 'alternate', req.href.blog(format='rss'), 'RSS Feed',
                      'application/rss+xml', 'rss')
+            add_link(req, 'alternate', req.href.blog(format='atom'),
+                     'Atom Feed', 'application/atom+xml', 'atom')
 
         
 
@@ -203,11 +259,11 @@ class FullBlogModule(Component):
             # Requesting the archive page
             template = 'fullblog_archive.html'
             data['blog_archive'] = []
-            for period, period_posts in group_posts_by_month(get_all_blog_posts(self.env)):
+            for period, period_posts in group_posts_by_month(
+                                    index.summaries(index.select())):
                 allowed_posts = []
                 for post in period_posts:
-                    bp = BlogPost(self.env, post[0], post[1])
-                    if 'BLOG_VIEW' in req.perm(bp.resource):
+                    if 'BLOG_VIEW' in req.perm(Resource('blog', post[0])):
                         allowed_posts.append(post)
                 if allowed_posts:
                     data['blog_archive'].append((period, allowed_posts))
@@ -236,8 +292,8 @@ class FullBlogModule(Component):
                 elif 'submitcomment' in req.args and not warnings:
                     warnings.extend(blog_core.create_comment(req, comment))
                     if not warnings:
-                        req.redirect(req.href.blog(pagename
-                                )+'#comment-'+str(comment.number))
+                        req.redirect(self._comment_href(req.href, pagename,
+                                                        comment.number))
                 data['blog_comment'] = comment
                 # Push all warnings out to the user.
                 for field, reason in warnings:
@@ -246,9 +302,24 @@ class FullBlogModule(Component):
                     else:
                         add_warning(req, reason)
             data['blog_post'] = the_post
+            # One page of comments, starting after 'comments_after'
+            try:
+                comments_after = max(0, int(req.args.get('comments_after', 0)))
+            except ValueError:
+                comments_after = 0
+            per_page = self.comments_per_page
+            comments = the_post.get_comments(after=comments_after,
+                                             limit=per_page and per_page + 1)
+            data['blog_comments_more'] = per_page and len(comments) > per_page
+            data['blog_comments'] = per_page and comments[:per_page] or comments
+            data['blog_comments_after'] = comments_after
+            data['blog_comment_href'] = self._comment_href
             context = Context.from_request(req, the_post.resource)
             data['context'] = context
             data['blog_attachments'] = AttachmentModule(self.env).attachment_data(context)
+            if self.related_posts:
+                data['blog_related'] = blog_core.get_related_posts(
+                        the_post.name, req.perm, self.related_posts)
             # Previous and Next ctxtnav
             prev, next = blog_core.get_prev_next_posts(req.perm, the_post.name)
             if prev:
@@ -410,8 +481,9 @@ class FullBlogModule(Component):
             if not (author or category or (from_dt and to_dt)):
                 raise HTTPNotFound("Not a valid path for viewing blog posts.")
             blog_posts = []
-            for post in get_blog_posts(self.env, category=category,
-                        author=author, from_dt=from_dt, to_dt=to_dt):
+            for post in index.summaries(index.select(category=category,
+                        author=author, from_dt=from_dt, to_dt=to_dt,
+                        order='version_time')[:self.max_listing]):
                 bp = BlogPost(self.env, post[0], post[1])
                 if 'BLOG_VIEW' in req.perm(bp.resource):
                     blog_posts.append(bp)
@@ -429,13 +501,16 @@ class FullBlogModule(Component):
                 data['blog_total'] = \
                     blog_core.get_months_authors_categories(
                         user=req.authname, perm=req.perm)
+        if self.popular_posts and self.config.getbool('fullblog',
+                                                      'count_views'):
+            data['blog_popular'] = get_popular_posts(self.env, req.perm,
+                                                     self.popular_posts)
         if 'BLOG_CREATE' in req.perm('blog'):
             add_ctxtnav(req, 'New Post', href=req.href.blog('create'),
                     title="Create new Blog Post")
         add_stylesheet(req, 'tracfullblog/css/fullblog.css')
         add_stylesheet(req, 'common/css/code.css')
-        data['blog_personal_blog'] = self.env.config.getbool('fullblog',
-                                                'personal_blog')
+        data['blog_personal_blog'] = settings['personal_blog']
         b=data['blog_categories']
         data['blog_categories']=sorted(b, key =lambda b:b[1],reverse=True)
         return (template, data, None)
@@ -481,8 +556,8 @@ class FullBlogModule(Component):
                 bp_resource = blog_realm(id=post_name, version=None)
                 if 'BLOG_VIEW' in req.perm(bp_resource):
                     bp = BlogPost(self.env, post_name)
-                    yield (req.href.blog(
-                            post_name)+'#comment-'+str(comment_number),
+                    yield (self._comment_href(req.href, post_name,
+                                              comment_number),
                         'Blog: '+bp.title+' (Comment '+str(comment_number)+')',
                         comment_time, comment_author,
                         shorten_result(text=comment, keywords=terms))
@@ -532,7 +607,7 @@ class FullBlogModule(Component):
              compat_format_0_11_2 = None
         if bc: # A blog comment
             if field == 'url':
-                return context.href.blog(bp.name) + '#comment-%d' % bc.number
+                return self._comment_href(context.href, bp.name, bc.number)
             elif field == 'title':
                 return tag('Blog: ', tag.em(bp.title), ' comment added')
             elif field == 'description':
@@ -564,6 +639,150 @@ class FullBlogModule(Component):
 
     # Internal methods
 
+    def _comment_href(self, href, post_name, number):
+        """ Returns the link to a comment, on the page of comments where it
+        is shown first when it is not on the first page. """
+        if self.comments_per_page and number > self.comments_per_page:
+            return href.blog(post_name, comments_after=number - 1) \
+                    + '#comment-%d' % number
+        return href.blog(post_name) + '#comment-%d' % number
+
+    def _send_cached_page(self, req):
+        """ Sends the stored output for the request, rendering and storing
+        it first if missing or made before the last change of the blog.
+        Output using the form token or showing notices or warnings is not
+        stored. """
+        blog_core = FullBlogCore(self.env)
+        store = blog_core.get_cache()
+        key = blog_core.get_cache_prefix() + 'page_' + sha1(
+                '%s?%s' % (to_utf8(req.path_info),
+                           req.query_string)).hexdigest()
+        family = blog_core.get_cache_prefix() + 'pages'
+        generation = get_generation(self.env)
+        cached = store(key, family=family)
+        if cached and cached[0] == generation:
+            content_type, body, gz_body, digest = cached[1:]
+        else:
+            if cached:
+                store.stale(family)
+            started = time.time()
+            template, data, content_type = self._render_request(req)
+            content_type = content_type or 'text/html'
+            body = Chrome(self.env).render_template(req, template, data,
+                                                    content_type)
+            gz_body = _gzip(body)
+            # Pages are also removed without a new generation, so the tag
+            # follows the content
+            digest = sha1(to_utf8(body)).hexdigest()[:16]
+            if not (req.form_token and req.form_token in body) \
+                    and not req.chrome.get('notices') \
+                    and not req.chrome.get('warnings'):
+                store(key, (generation, content_type, body, gz_body, digest),
+                      family)
+                store.computed(family, time.time() - started)
+        etag = '%s-%s' % (generation, digest)
+        gzipped = 'gzip' in (req.get_header('Accept-Encoding') or '')
+        if gzipped:
+            body = gz_body
+            etag += '-gzip'
+        etag = '"%s"' % etag
+        if req.get_header('If-None-Match') == etag:
+            req.send_response(304)
+            req.send_header('Vary', 'Accept-Encoding')
+            req.send_header('ETag', etag)
+            req.end_headers()
+            raise RequestDone
+        req.send_response(200)
+        req.send_header('Content-Type', content_type + ';charset=utf-8')
+        if gzipped:
+            req.send_header('Content-Encoding', 'gzip')
+        req.send_header('Content-Length', len(body))
+        req.send_header('Vary', 'Accept-Encoding')
+        req.send_header('ETag', etag)
+        req.end_headers()
+        req.write(body)
+        raise RequestDone
+
+    def _render_atom(self, req, command, pagename, listing_data):
+        """ Atom feed of posts for the front page and listings, or of
+        comments for a post ('/blog/<name>?format=atom') or the whole blog
+        ('feed=comments'). Entries are paged with 'page', linked as
+        described in RFC 5005, and 'since=<timestamp>' only returns entries
+        changed after that time. """
+        try:
+            page = max(1, int(req.args.get('page', 1)))
+            since = int(req.args.get('since', 0))
+        except ValueError:
+            raise HTTPNotFound("Not a valid page or time for the feed.")
+        per_page = self.num_items or 20
+        offset = (page - 1) * per_page
+        data = {'blog_feed_title': '', 'blog_post_list': [],
+                'blog_comment_list': [],
+                'blog_about': FullBlogCore(self.env).get_settings()['about'],
+                'blog_comment_href': self._comment_href,
+                'context': Context.from_request(req, absurls=True)}
+        if command == 'view' or (not command
+                                 and req.args.get('feed') == 'comments'):
+            if command == 'view':
+                the_post = BlogPost(self.env, pagename)
+                req.perm(the_post.resource).require('BLOG_VIEW')
+                if not the_post.version:
+                    raise HTTPNotFound("No blog post named '%s'." % pagename)
+                data['blog_feed_title'] = "Comments for %s" % the_post.title
+            else:
+                data['blog_feed_title'] = "Comments"
+            rows = get_recent_blog_comments(self.env, pagename, since,
+                                            per_page + 1, offset)
+            has_next = len(rows) > per_page
+            data['blog_comment_list'] = [row for row in rows[:per_page]
+                    if 'BLOG_VIEW' in req.perm(Resource('blog', row[0]))]
+            times = [row[4] for row in rows[:1]]
+        elif not command or command.startswith('listing-'):
+            index = get_post_index(self.env)
+            positions = index.select(category=listing_data.get('category'),
+                    author=listing_data.get('author'),
+                    from_dt=listing_data.get('from_dt'),
+                    to_dt=listing_data.get('to_dt'), order='version_time')
+            if since:
+                # Newest first, so stop at the first one not changed since
+                positions = list(takewhile(
+                        lambda p: index.version_times[p] > since, positions))
+            has_next = len(positions) > offset + per_page
+            for name, version in [(index.names[p], index.versions[p])
+                        for p in positions[offset:offset + per_page]]:
+                bp = BlogPost(self.env, name, version)
+                if 'BLOG_VIEW' in req.perm(bp.resource):
+                    data['blog_post_list'].append(bp)
+            times = [to_datetime(index.version_times[p], utc)
+                     for p in positions[:1]]
+            data['blog_feed_title'] = (listing_data.get('category')
+                                       or listing_data.get('author') or '')
+        else:
+            raise HTTPNotFound("No feed for this blog path.")
+        updated = times and times[0] or to_datetime(since, utc)
+        req.check_modified(updated, '%s/%s' % (get_generation(self.env),
+                                               req.query_string))
+
+        def feed_href(page_number):
+            args = {'format': 'atom'}
+            for name in ('feed', 'since'):
+                if req.args.get(name):
+                    args[name] = req.args[name]
+            if page_number > 1:
+                args['page'] = page_number
+            return req.abs_href.blog(req.args.get('blog_path') or None,
+                                     **args)
+        data['blog_feed_self'] = feed_href(page)
+        data['blog_feed_links'] = [('first', feed_href(1))]
+        if page > 1:
+            data['blog_feed_links'].append(('previous', feed_href(page - 1)))
+        if has_next:
+            data['blog_feed_links'].append(('next', feed_href(page + 1)))
+        data['blog_feed_updated'] = updated
+        data['blog_atom_date'] = lambda dt: \
+                dt.astimezone(utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return 'fullblog.atom', data, 'application/atom+xml'
+
     def _parse_path(self, req):
         """ Parses the request path for the blog and returns a
         ('command', 'pagename', 'path_items', 'listing_data') tuple. """
@@ -597,3 +816,14 @@ class FullBlogModule(Component):
             command = 'view'
             pagename = path
         return (command, pagename, path_items, listing_data)
+
+
+def _gzip(body):
+    """ Returns body compressed in gzip format. """
+    buf = StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    try:
+        fp.write(body)
+    finally:
+        fp.close()
+    return buf.getvalue()